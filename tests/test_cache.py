@@ -0,0 +1,133 @@
+import os
+import sys
+
+import pytest
+import ush
+from six import BytesIO
+
+from helper import STDOUT, cat, echo, repeat, s
+
+
+CALLS = []
+
+
+def count(line):
+    # module level, since closures over mutable objects are not cached
+    CALLS.append(line)
+    return line
+
+
+@pytest.fixture()
+def counted():
+    del CALLS[:]
+    return CALLS, ush.py_stage(count)
+
+
+def test_cached_call_str_and_iter(counted):
+    calls, stage = counted
+    cache = ush.ResultCache()
+    pipeline = repeat('-c', '3', 'ab\n', cache=cache) | stage
+    assert str(pipeline) == s('ab\nab\nab\n')
+    assert len(calls) == 3
+    assert str(pipeline) == s('ab\nab\nab\n')
+    assert list(pipeline) == ['ab', 'ab', 'ab']
+    assert list(pipeline.iter_raw()) == [s(b'ab\nab\nab\n')]
+    sink = BytesIO()
+    assert (pipeline | sink)() == (0, 0)
+    assert sink.getvalue() == s(b'ab\nab\nab\n')
+    assert len(calls) == 3
+    assert cache.stats['hits'] == 4
+    assert cache.stats['misses'] == 1
+
+
+def test_cache_key_includes_stdin_and_argv(counted):
+    calls, stage = counted
+    cache = ush.ResultCache()
+    assert str(echo(b'x\n') | cat(cache=cache) | stage) == 'x\n'
+    assert str(echo(b'x\n') | cat(cache=cache) | stage) == 'x\n'
+    assert str(echo(b'y\n') | cat(cache=cache) | stage) == 'y\n'
+    assert str(echo(b'y\n') | cat('-', cache=cache) | stage) == 'y\n'
+    assert len(calls) == 3
+
+
+def test_cache_inputs(tmpdir):
+    cache = ush.ResultCache(fingerprint='content')
+    path = str(tmpdir.join('input'))
+    with open(path, 'wb') as f:
+        f.write(b'1')
+    assert str(cat(path, cache=cache, cache_inputs=[path])) == '1'
+    with open(path, 'wb') as f:
+        f.write(b'2')
+    assert str(cat(path, cache=cache, cache_inputs=[path])) == '2'
+    assert str(cat(path, cache=cache, cache_inputs=[path])) == '2'
+    assert cache.stats['hits'] == 1
+
+
+def test_failures_are_not_cached():
+    cache = ush.ResultCache()
+    assert cat('inexistent-file', cache=cache)() != (0,)
+    assert cat('inexistent-file', cache=cache)() != (0,)
+    assert cache.stats['stores'] == 0
+
+
+def test_disk_store_and_eviction(tmpdir, counted):
+    calls, stage = counted
+    path = str(tmpdir.join('cache'))
+    cache = ush.ResultCache(path, max_bytes=1024)
+    assert str(repeat('-c', '2', 'a\n', cache=cache) | stage) == s('a\na\n')
+    cache = ush.ResultCache(path, max_bytes=1024)
+    assert str(repeat('-c', '2', 'a\n', cache=cache) | stage) == s('a\na\n')
+    assert len(calls) == 2
+    assert cache.stats['hits'] == 1
+    str(repeat('-c', '505', 'b\n', cache=cache) | stage)
+    assert cache.stats['evictions'] == 1
+    assert len(os.listdir(path)) == 1
+
+
+def test_disk_entry_format(tmpdir):
+    path = str(tmpdir.join('cache'))
+    cache = ush.ResultCache(path)
+    assert str(echo(b'x\n') | cat(cache=cache)) == s('x\n')
+    name, = os.listdir(path)
+    with open(os.path.join(path, name), 'rb') as f:
+        assert f.read() == b'[0]\n' + s(b'x\n')
+    with open(os.path.join(path, name), 'wb') as f:
+        f.write(b'\x80\x02corrupt')
+    cache = ush.ResultCache(path)
+    assert str(echo(b'x\n') | cat(cache=cache)) == s('x\n')
+    assert cache.stats['misses'] == 1
+
+
+def test_memory_lru():
+    cache = ush.ResultCache(memory_entries=1)
+    str(echo(b'1') | cat(cache=cache))
+    str(echo(b'2') | cat(cache=cache))
+    str(echo(b'1') | cat(cache=cache))
+    assert cache.stats['hits'] == 0
+    str(echo(b'1') | cat(cache=cache))
+    assert cache.stats['hits'] == 1
+
+
+def test_cache_key_includes_python_stage_code(counted):
+    cache = ush.ResultCache()
+    upper = ush.py_stage(lambda line: line.upper())
+    lower = ush.py_stage(lambda line: line.lower())
+    assert str(echo(b'Hello\n') | cat(cache=cache) | upper) == 'HELLO\n'
+    assert str(echo(b'Hello\n') | cat(cache=cache) | lower) == 'hello\n'
+    calls, stage = counted
+    closure = ush.py_stage(lambda line: stage.fn(line))
+    assert str(echo(b'Hello\n') | cat(cache=cache) | closure) == 'Hello\n'
+    assert str(echo(b'Hello\n') | cat(cache=cache) | closure) == 'Hello\n'
+    assert len(calls) == 2
+    assert cache.stats == {'hits': 0, 'misses': 2, 'stores': 2,
+                           'evictions': 0}
+
+
+def test_cache_key_includes_redirects():
+    cache = ush.ResultCache()
+    python = ush.Shell()(sys.executable)
+    both = python('-c', 'import sys; sys.stdout.write("out\\n"); '
+                        'sys.stdout.flush(); sys.stderr.write("err\\n")')
+    assert str(both(cache=cache, stderr=STDOUT)) == 'out\nerr\n'
+    assert str(both(cache=cache, stderr=ush.sinks.Null())) == 'out\n'
+    assert cache.stats['hits'] == 0
@@ -1,7 +1,10 @@
 import hashlib
+import itertools
 import os
+import sys
 
 import pytest
+import ush
 from six import BytesIO, StringIO, PY2
 
 from helper import *
@@ -186,3 +189,784 @@ def test_big_data(chunk_factor):
     assert stderr_1 == s(b'80365aea26be3a31ce7f953d7b01ea0d\n')
     assert stderr_2 == s(b'80365aea26be3a31ce7f953d7b01ea0d\n')
     assert md5.hexdigest() == '80365aea26be3a31ce7f953d7b01ea0d'
+
+
+@pytest.mark.skipif(not ush.HAS_MEMFD, reason='memfd_create not available')
+def test_memfd_capture():
+    assert str(repeat('-c', '5', '123', memfd=True)) == '123123123123123'
+    assert bytes(echo(s(b'abc\ndef')) | cat(memfd=True)) == s(b'abc\ndef')
+    assert bytes(repeat('-c', '0', '123', memfd=True)) == b''
+    data = 'x' * (4 * 1024 * 1024)
+    assert len(bytes(repeat('-c', '4096', 'x' * 1024, memfd=True))) == len(data)
+    # iterators still go through pipes
+    assert list(repeat('-c', '2', '12', memfd=True)) == ['1212']
+
+
+def upper(line):
+    return line.upper()
+
+
+def test_py_stage():
+    assert str(cat('.textfile') | ush.py_stage(lambda l: l[:-1] + b'!\n') |
+               cat) == s('123!\n1234!\n12345!\n')
+    assert str(echo(b'abc\ndef\n') | ush.py_stage(upper)) == 'ABC\nDEF\n'
+    assert (echo(b'abc') | ush.py_stage(upper) | cat)() == (0, 0)
+
+
+def test_py_stage_generator():
+    def numbered(lines):
+        for i, line in enumerate(lines):
+            yield '{0}:'.format(i)
+            yield line
+    assert list(echo(b'a\nb\n') | ush.py_stage(numbered) | cat) == [
+        '0:a', '1:b']
+
+
+def test_py_stage_chunks_big_data():
+    def count(chunks):
+        total = 0
+        for chunk in chunks:
+            total += len(chunk)
+            yield chunk
+        yield str(total)
+    sink = BytesIO()
+    assert (repeat('-c', 100000, 'x' * 100) |
+            ush.py_stage(count, mode='chunks') | head('-c', 10) |
+            sink)()[1:] == (0, 0)
+    assert sink.getvalue() == b'x' * 10
+    output = str(repeat('-c', 100000, 'x' * 100) |
+                 ush.py_stage(count, mode='chunks'))
+    assert output == 'x' * 10000000 + '10000000'
+
+
+def test_py_stage_lines_closed_output():
+    sink = BytesIO()
+    assert (repeat('-c', 100000, 'x\n') | ush.py_stage(lambda l: l) |
+            head('-c', 2) | sink)()[1:] == (0, 0)
+    assert sink.getvalue() == b'x\n'
+
+
+def test_py_stage_failure():
+    def fail(line):
+        raise Exception('failed')
+    assert (echo(b'abc') | ush.py_stage(fail) | cat)() == (1, 0)
+    with pytest.raises(ush.ProcessError) as e:
+        (echo(b'abc') | ush.py_stage(fail) | cat(raise_on_error=True))()
+    assert [str(error) for error in e.value.errors] == ['failed']
+    assert 'failed' in str(e.value)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+def test_py_stage_process_worker():
+    assert str(echo(b'abc\n') | ush.py_stage(upper, worker='process') |
+               cat) == 'ABC\n'
+
+
+def test_close_iterator_tears_down_pipeline():
+    iterator = (repeat('-c', 100000000, 'x' * 100) | cat).iter_raw()
+    assert next(iterator)
+    iterator.close()
+    assert all(proc.returncode is not None for proc in iterator.procs)
+
+
+def test_iterator_context_manager():
+    with iter(repeat('-c', 100000000, 'x\n') | cat | cat) as lines:
+        assert next(lines) == 'x'
+    assert all(proc.returncode is not None for proc in lines.procs)
+
+
+def test_abandoned_iterator_is_torn_down():
+    procs = []
+    def first_line():
+        iterator = iter(repeat('-c', 100000000, 'x\n') | cat)
+        for line in iterator:
+            procs.extend(iterator.procs)
+            return line
+    assert first_line() == 'x'
+    assert all(proc.returncode is not None for proc in procs)
+
+
+def test_head():
+    endless = repeat('-c', 100000000, '0123456789\n')
+    assert endless.head(lines=2) == ['0123456789', '0123456789']
+    assert (endless | cat).head(bytes=15) == s(b'0123456789\n0123')
+    assert (endless | cat).head(lines=0) == []
+    assert (echo(b'a\nb') | cat).head(lines=5) == ['a', 'b']
+    assert (echo(b'abc') | cat).head(bytes=5) == b'abc'
+    with pytest.raises(TypeError):
+        endless.head()
+
+
+def test_first():
+    assert cat('.textfile').first('^1234') == '1234'
+    assert cat('.textfile').first(r'\d{6}') is None
+    numbers = (('{0}\n'.format(i) for i in itertools.count()) | cat)
+    assert numbers.first('^5000$') == '5000'
+
+
+@pytest.mark.skipif(not ush.HAS_PIDFD, reason='pidfd_open not available')
+def test_exits_observed_in_any_order():
+    procs, raise_on_error = (repeat('-c', 100000000, 'x') | cat |
+                             head('-c', 1) | ush.NULL)._spawn()
+    exited = []
+    assert ush.wait(procs, raise_on_error, exited.append)[2] == 0
+    assert exited[0] is procs[2]
+    assert sorted(p.pid for p in exited) == sorted(p.pid for p in procs)
+
+
+@pytest.mark.parametrize('use_pidfd', [True, False])
+def test_fail_fast(monkeypatch, use_pidfd):
+    if use_pidfd and not ush.HAS_PIDFD:
+        pytest.skip('pidfd_open not available')
+    monkeypatch.setattr(ush, 'HAS_PIDFD', use_pidfd)
+    pipeline = (cat('inexistent-file', fail_fast=True) |
+                repeat('-c', 100000000, 'x') | cat | ush.NULL)
+    with pytest.raises(ush.ProcessError) as e:
+        pipeline()
+    statuses = [info[2] for info in e.value.process_info]
+    assert statuses[0] not in (0, None)
+    assert None in statuses[1:]
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='requires SIGPIPE')
+def test_fail_fast_ignores_sigpipe():
+    yes = ush.Shell()('yes')
+    assert (yes(fail_fast=True) | head('-c', 1) | ush.NULL)()[1] == 0
+
+
+class RecordingLogger(object):
+    def __init__(self):
+        self.records = []
+
+    def log(self, level, fmt, *args, **kwargs):
+        self.records.append((level, fmt % args, kwargs['extra']))
+
+
+def test_stderr_to_logger():
+    logger = RecordingLogger()
+    source = echo(b'123\n')
+    pipeline = (source | errmd5(stderr=ush.to_logger(logger, 30, 'md5: ')) |
+                errmd5(stderr=ush.to_logger(logger, 40)) | ush.NULL)
+    assert pipeline() == (0, 0)
+    assert sorted(r[:2] for r in logger.records) == [
+        (30, 'md5: ba1f2511fc30423bdbb183fe33f3dd0f'),
+        (40, 'ba1f2511fc30423bdbb183fe33f3dd0f'),
+    ]
+    assert all(r[2]['pid'] for r in logger.records)
+    assert all('errmd5.py' in r[2]['command'] for r in logger.records)
+
+
+def test_logger_sink_batching_and_limits():
+    logger = RecordingLogger()
+    sink = ush.to_logger(logger, 20, batch_lines=2, max_line_length=5,
+                         rate_limit=3).bind(1, ['cmd'])
+    sink.write(b'a\nb\nc')
+    sink.write(b'\nd\n0123456789')
+    sink.finish()
+    assert [r[1] for r in logger.records] == [
+        'a\nb', 'c', '[2 lines suppressed]']
+    sink = ush.to_logger(logger, 20, max_line_length=5).bind(1, ['cmd'])
+    logger.records = []
+    sink.write(b'0123456789\nab')
+    sink.finish()
+    assert [r[1] for r in logger.records] == ['01234...[truncated]', 'ab']
+    logger.records = []
+    sink.write(b'a' * 30)
+    sink.write(b'b' * 30)
+    sink.write(b'b\nc\n')
+    sink.finish()
+    assert [r[1] for r in logger.records] == ['aaaaa...[truncated]', 'c']
+
+
+def test_logger_sink_cached_output():
+    logger = RecordingLogger()
+    cache = ush.ResultCache()
+    for i in range(2):
+        sink = ush.to_logger(logger, 20)
+        assert (echo(b'a\nb') | cat(cache=cache) | sink)() == (0,)
+    assert [r[1] for r in logger.records] == ['a', 'b', 'a', 'b']
+    assert cache.stats['hits'] == 1
+
+
+@pytest.mark.parametrize('stdin_buffer_size', [0, 1, 100, None])
+def test_stdin_coalescing(stdin_buffer_size):
+    command = cat
+    if stdin_buffer_size is not None:
+        command = cat(stdin_buffer_size=stdin_buffer_size)
+    items = (str(i) for i in range(10000))
+    expected = ''.join(str(i) for i in range(10000))
+    assert str(items | command) == expected
+    assert str(['a', '', b'b', 3] | command) == 'ab3'
+
+
+def test_stdin_generator_latency():
+    import time
+
+    def slow_items():
+        for i in range(5):
+            time.sleep(0.3)
+            yield '{0}\n'.format(i)
+
+    python = ush.Shell()(sys.executable)
+    # copies lines without waiting for a full buffer
+    copy = python('-u', '-c', 'import sys\n'
+                  'for line in iter(sys.stdin.readline, ""):\n'
+                  '    sys.stdout.write(line)')
+    start = time.time()
+    for line in slow_items() | copy:
+        assert line == '0'
+        break
+    assert time.time() - start < 1
+
+
+def test_next_stdin_chunk():
+    items = iter(['a', b'bc', '', 'def', 'g'])
+    assert ush.next_stdin_chunk(items, 3) == [b'a', b'bc']
+    assert ush.next_stdin_chunk(items, 0) == b'def'
+    assert ush.next_stdin_chunk(items, 100) == b'g'
+    assert ush.next_stdin_chunk(items, 100) is None
+
+
+def test_sinks():
+    from ush.sinks import Count, Digest, Null
+    digest = Digest('sha256')
+    assert (repeat_hex | digest)() == (0,)
+    assert digest.hexdigest() == ('1f1a5c83e53c9faa87badd5d17c45ffec'
+                                  '49b137430c9817dd5c9420fd96aaa3e')
+    count = Count()
+    assert (cat('.textfile') | count)() == (0,)
+    assert (count.lines, count.bytes) == (3, len(s(b'123\n1234\n12345\n')))
+    count = Count(lines=False)
+    assert (cat('.textfile') | cat | count)() == (0, 0)
+    assert (count.lines, count.bytes) == (0, len(s(b'123\n1234\n12345\n')))
+    assert (cat('.textfile') | ush.sinks.Null())() == (0,)
+    assert (echo(b'abc') | errmd5(stderr=Null()) | Null())() == (0,)
+
+
+def test_partition_sink(tmpdir):
+    template = str(tmpdir.join('part-{0}'))
+    partition = ush.sinks.Partition(lambda line: int(line) % 3, 3, template)
+    source = (str(i) + '\n' for i in range(10))
+    assert (source | cat | partition)() == (0,)
+    with open(template.format(0), 'rb') as f:
+        assert f.read() == b'0\n3\n6\n9\n'
+    with open(template.format(2), 'rb') as f:
+        assert f.read() == b'2\n5\n8\n'
+    partition = ush.sinks.Partition(lambda line: line[:1], 2, template)
+    assert (echo(b'a1\nx1\na2\nx2') | cat | partition)() == (0,)
+    contents = []
+    for i in range(2):
+        with open(template.format(i), 'rb') as f:
+            contents.append(f.read())
+    assert sorted(contents) == [b'a1\na2\n', b'x1\nx2']
+    cache = ush.ResultCache()
+    for i in range(2):
+        partition = ush.sinks.Partition(lambda line: 0, 1, template)
+        assert (echo(b'a\nb') | cat(cache=cache) | partition)() == (0,)
+        assert not partition.files
+        with open(template.format(0), 'rb') as f:
+            assert f.read() == b'a\nb'
+    assert cache.stats['hits'] == 1
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'),
+                    reason='requires linux')
+@pytest.mark.skipif(PY2, reason='requires os.sched_getaffinity')
+def test_scheduling_options():
+    python = ush.Shell()(sys.executable)
+    assert str(python('-c', 'import os; print(os.nice(0))',
+                      nice=3)).strip() == str(os.nice(0) + 3)
+    cpu = sorted(os.sched_getaffinity(0))[-1]
+    assert str(python('-c', 'import os; print(os.sched_getaffinity(0))',
+                      cpu_affinity=[cpu])).strip() == str({cpu})
+    assert str(cat('/proc/self/oom_score_adj',
+                   oom_score_adj=500)).strip() == '500'
+    if ush.find_executable('ionice', os.environ, os.getcwd()) is None:
+        return
+    ionice = ush.Shell()('ionice')
+    assert str(ionice(ionice='idle')).strip() == 'idle'
+    assert str(ionice(ionice=('best-effort', 7))).strip() == (
+        'best-effort: prio 7')
+
+
+def test_spread_cpus():
+    policy = ush.spread_cpus(3, cpus=range(8))
+    assert [sorted(s) for s in policy.cpusets] == [
+        [0, 1, 2], [3, 4, 5], [6, 7]]
+    assert [sorted(policy.acquire()) for i in range(4)] == [
+        [0, 1, 2], [3, 4, 5], [6, 7], [0, 1, 2]]
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'),
+                    reason='requires linux')
+@pytest.mark.skipif(PY2, reason='requires os.sched_getaffinity')
+def test_cpu_affinity_policy():
+    python = ush.Shell(cpu_affinity=ush.spread_cpus())(sys.executable)
+    script = ('import os, sys; sys.stdout.write(sys.stdin.read()); '
+              'print(sorted(os.sched_getaffinity(0)))')
+    first, second = list(echo(b'') | python('-c', script) |
+                         python('-c', script))
+    assert first == second
+
+
+@pytest.fixture()
+def numbers_file(tmpdir):
+    path = str(tmpdir.join('numbers'))
+    with open(path, 'wb') as f:
+        f.write(b''.join(b'%d\n' % i for i in range(10000)))
+    return path
+
+
+@pytest.mark.parametrize('shards', [1, 3, 8])
+def test_parallel_ordered(numbers_file, shards):
+    sink = BytesIO()
+    statuses = (cat | cat | sink).parallel(input=numbers_file, shards=shards)
+    assert statuses == [(0, 0)] * shards
+    with open(numbers_file, 'rb') as f:
+        assert sink.getvalue() == f.read()
+
+
+def test_parallel_merged(numbers_file, tmpdir):
+    output = str(tmpdir.join('output'))
+    statuses = (cat | output).parallel(input=numbers_file, shards=4,
+                                       ordered=False)
+    assert statuses == [(0,)] * 4
+    with open(output, 'rb') as f:
+        lines = f.read().splitlines()
+    assert sorted(int(l) for l in lines) == list(range(10000))
+
+
+def test_parallel_errors(numbers_file):
+    with pytest.raises(ush.ProcessError) as e:
+        (cat('-', 'inexistent-file', raise_on_error=True) |
+         ush.sinks.Null()).parallel(input=numbers_file, shards=2)
+    assert len(e.value.process_info) == 2
+    with pytest.raises(OSError):
+        (ush.Shell()('inexistent-command') |
+         ush.sinks.Null()).parallel(input=numbers_file, shards=3)
+    with pytest.raises(ush.AlreadyRedirected):
+        (cat(stdin=numbers_file) |
+         ush.sinks.Null()).parallel(input=numbers_file, shards=3)
+
+
+def test_shard_ranges(numbers_file):
+    ranges = ush.shard_ranges(numbers_file, 7)
+    assert ranges[0][0] == 0
+    assert ranges[-1][1] == os.path.getsize(numbers_file)
+    with open(numbers_file, 'rb') as f:
+        data = f.read()
+    for start, end in ranges:
+        assert start == 0 or data[start - 1:start] == b'\n'
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='requires /dev/fd')
+@pytest.mark.skipif(PY2, reason='requires pass_fds')
+def test_procsub_read(tmpdir):
+    tmpdir.join('left').write('a\nb\nc\n')
+    tmpdir.join('right').write('a\nc\nd\n')
+    comm = ush.Shell()('comm')
+    left = ush.procsub(cat(str(tmpdir.join('left'))))
+    right = ush.procsub(cat(str(tmpdir.join('right'))) | cat)
+    assert str(comm('-3', left, right)) == 'b\n\td\n'
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='requires /dev/fd')
+@pytest.mark.skipif(PY2, reason='requires pass_fds')
+def test_procsub_write(tmpdir):
+    output = str(tmpdir.join('output'))
+    sink = BytesIO()
+    tee = ush.Shell()('tee')
+    (echo(b'foo\n') | tee(ush.procsub(cat | output, mode='w')) | sink)()
+    assert sink.getvalue() == b'foo\n'
+    with open(output, 'rb') as f:
+        assert f.read() == b'foo\n'
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='requires /dev/fd')
+@pytest.mark.skipif(PY2, reason='requires pass_fds')
+def test_procsub_errors():
+    failing = ush.procsub(cat('inexistent-file', raise_on_error=True,
+                              stderr=ush.sinks.Null()))
+    with pytest.raises(ush.ProcessError) as e:
+        cat(failing)()
+    assert e.value.process_info[0][2] != 0
+    with pytest.raises(ush.InvalidPipeline):
+        cat(ush.procsub(echo(b'x') | cat))()
+    with pytest.raises(ValueError):
+        ush.procsub(cat, mode='x')
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='requires /dev/fd')
+@pytest.mark.skipif(PY2, reason='requires pass_fds')
+def test_procsub_repr():
+    sh = ush.Shell()
+    assert repr(sh('cat')(ush.procsub(sh('ls')('-l')))) == 'cat <(ls -l)'
+
+
+def test_pipeline_composition():
+    upper = fold('-w', 2) | cat
+    lower = cat | head('-c', 5)
+    pipeline = echo(b'abcdef\n') | upper | lower
+    assert len(pipeline.commands) == 4
+    assert str(pipeline) == 'ab\ncd'
+    with pytest.raises(ush.InvalidPipeline):
+        (cat | cat('-n') | '.output') | (cat | cat)
+
+
+def test_pipeline_start():
+    handle = (repeat('-c', 1000, 'x') | cat).start()
+    assert len(handle.pids) == 2
+    sink = BytesIO()
+    assert (handle | cat | sha256sum | sink)() == (0, 0)
+    assert handle.wait() == (0, 0)
+    assert sink.getvalue() == bytes(repeat('-c', 1000, 'x') | sha256sum)
+
+
+def test_pipeline_start_teardown():
+    with pytest.raises(KeyError):
+        with repeat('-c', 10 ** 9, 'x').start() as handle:
+            raise KeyError()
+    assert handle.wait()[0] != 0
+    with repeat('-c', 10, 'x').start() as handle:
+        pass
+    assert handle.wait() == (0,)
+    with pytest.raises(ush.InvalidPipeline):
+        (echo(b'x') | cat).start()
+
+
+@pytest.mark.parametrize('backend', ['select', 'threads',
+                                     ush.IOThreadPool(size=3)])
+def test_io_backends(backend):
+    data = b'x' * (1 << 20) + b'\nend\n'
+    pipeline = cat(io_backend=backend, stderr=PIPE) | cat
+    assert bytes(echo(data) | pipeline) == data
+    assert list(echo(b'a\nb\n') | pipeline) == [(None, 'a'), (None, 'b')]
+    assert (echo(data) | pipeline | head('-c', 10)).head(lines=1) == [
+        'xxxxxxxxxx']
+
+
+@pytest.mark.parametrize('backend', ['select', 'threads',
+                                     ush.IOThreadPool(size=3)])
+def test_io_backends_stop_early(backend):
+    # the stderr pipe is never written, so a worker is blocked reading it
+    endless = repeat('-c', 10 ** 9, 'x\n', io_backend=backend, stderr=PIPE)
+    assert len((endless | cat).head(lines=1)) == 1
+    with iter(endless | cat) as lines:
+        assert next(lines)
+    assert all(proc.returncode is not None for proc in lines.procs)
+    writer = cat(stdin=itertools.repeat(b'x\n'), io_backend=backend,
+                 stderr=PIPE)
+    assert len((writer | cat).head(lines=1)) == 1
+
+
+def test_io_thread_pool_reuse():
+    import threading
+    # pools of other tests keep their threads alive
+    threads = threading.active_count()
+    pool = ush.IOThreadPool(size=3)
+    pipeline = cat(io_backend=pool, stderr=PIPE)
+    for i in range(20):
+        assert bytes(echo(b'abc') | pipeline) == b'abc'
+    assert pool.threads == 3
+    assert pool.idle == 3
+    assert threading.active_count() <= threads + 3
+    with pytest.raises(ValueError):
+        cat(io_backend='invalid')()
+    with pytest.raises(ValueError):
+        bytes(echo(b'abc') | cat(io_backend=ush.IOThreadPool(size=2),
+                                 stderr=PIPE))
+
+
+def test_io_thread_pool_bounded():
+    import threading
+    pool = ush.IOThreadPool(size=3)
+    pipeline = cat(io_backend=pool, stderr=PIPE)
+    results = []
+
+    def run():
+        results.append(bytes(echo(b'abc') | pipeline))
+
+    threads = [threading.Thread(target=run) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [b'abc'] * 20
+    assert pool.threads == 3
+
+
+def line_length(line):
+    return len(line)
+
+
+@pytest.mark.skipif(PY2, reason='requires concurrent.futures')
+def test_map_lines():
+    data = b''.join(b'x' * (i % 7) + b'\n' for i in range(5000))
+    expected = [i % 7 for i in range(5000)]
+    assert list((echo(data) | cat).map_lines(line_length, workers=2,
+                                             batch_size=100)) == expected
+    assert sorted((echo(data) | cat).map_lines(
+        line_length, workers=2, batch_size=100,
+        ordered=False)) == sorted(expected)
+    assert list((echo(b'ab\ncde') | cat).map_lines(line_length,
+                                                   workers=1)) == [2, 3]
+
+
+@pytest.mark.skipif(PY2, reason='requires concurrent.futures')
+def test_map_lines_early_exit():
+    results = repeat('-c', 10 ** 9, 'xx\n').map_lines(
+        line_length, workers=1, batch_size=10)
+    assert next(results) == 2
+    results.close()
+
+
+def test_offload(tmpdir):
+    output = str(tmpdir.join('output'))
+    pipeline = repeat('-c', 1000, 'it\'s "x"\n', offload=True) | fold(
+        '-w', 3) | output
+    assert ush.compile_offload_script(pipeline.commands, '/dev/null')
+    assert pipeline() == (0, 0)
+    with open(output, 'rb') as f:
+        assert f.read() == bytes(repeat('-c', 1000, 'it\'s "x"\n') |
+                                 fold('-w', 3))
+    (cat(output, offload=True) | sha256sum | output + '+')()
+    with open(output, 'rb') as f:
+        assert f.read().endswith(b'\n') is True
+
+
+def test_offload_env_cwd(tmpdir):
+    output = str(tmpdir.join('output'))
+    (env(env={'USH_OFFLOAD': 'a b', 'HOME': None}, offload=True) |
+     output)()
+    with open(output) as f:
+        lines = f.read().splitlines()
+    assert 'USH_OFFLOAD=a b' in lines
+    assert not any(l.startswith('HOME=') for l in lines)
+    (env(env={'USH_OFFLOAD': '1'}, merge_env=False, offload=True) |
+     output)()
+    with open(output) as f:
+        assert f.read() == 'USH_OFFLOAD=1\n'
+    (pwd(cwd=str(tmpdir), offload=True) | output)()
+    with open(output) as f:
+        assert f.read().strip() == str(tmpdir)
+
+
+def test_offload_status_codes(tmpdir):
+    output = str(tmpdir.join('output'))
+    python = ush.Shell()(sys.executable)
+    kill = python('-c', 'import os; os.kill(os.getpid(), 9)')
+    assert (kill(offload=True) | cat | output)() == (-9, 0)
+    assert (cat('inexistent', offload=True, stderr=ush.sinks.Null()) |
+            output)() == (2,)
+    with pytest.raises(ush.ProcessError) as e:
+        (cat('inexistent', offload=True, raise_on_error=True,
+             stderr=STDOUT) | output)()
+    assert e.value.process_info[0][2] == 2
+    exit = python('-c', 'import sys; sys.exit(int(sys.argv[1]))')
+    for status in (200, 255):
+        assert exit(status, offload=True)() == exit(status)() == (status,)
+
+
+def test_offload_fallback():
+    sink = BytesIO()
+    pipeline = echo(b'abc') | cat(offload=True) | sink
+    assert ush.compile_offload_script(pipeline.commands, '/dev/null') is None
+    assert pipeline() == (0,)
+    assert sink.getvalue() == b'abc'
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'),
+                    reason='requires /proc')
+def test_offload_fallback_closes_pipe():
+    fds = len(os.listdir('/proc/self/fd'))
+    for _ in range(5):
+        assert (echo(b'abc') | cat(offload=True) | ush.sinks.Null())() == (0,)
+    assert len(os.listdir('/proc/self/fd')) == fds
+
+
+def test_run_capture():
+    python = ush.Shell()(sys.executable)
+    warn = python('-c', 'import sys; sys.stderr.write("warn\\n"); '
+                        'sys.stdout.write(sys.stdin.read())')
+    fail = python('-c', 'import sys; sys.stdout.write(sys.stdin.read()); '
+                        'sys.stderr.write("fail\\n"); sys.exit(3)')
+    result = (echo(b'abc\n') | warn | fail).run()
+    assert result.stdout == b'abc\n'
+    assert result.stderr == [b'warn\n', b'fail\n']
+    assert result.returncodes == (0, 3)
+    assert len(result.pids) == 2
+    assert len(result.durations) == 2
+    assert all(0 <= d <= result.duration for d in result.durations)
+    result = (echo(b'abc\n') | warn | fail).run(stderr='merged',
+                                                encoding='utf-8')
+    assert result.stdout == 'abc\n'
+    assert sorted(result.stderr.splitlines()) == ['fail', 'warn']
+    assert not hasattr(result, '__dict__')
+
+
+def test_run_no_capture():
+    sink = BytesIO()
+    result = (echo(b'abc') | cat | sink).run(capture=False)
+    assert result.stdout is None
+    assert result.stderr is None
+    assert result.returncodes == (0,)
+    assert sink.getvalue() == b'abc'
+    result = (echo(b'abc') | cat | sink).run()
+    assert result.stdout is None
+    assert result.stderr == [b'']
+    with pytest.raises(ValueError):
+        cat.run(stderr='invalid')
+
+
+def test_graph(tmpdir):
+    source = str(tmpdir.join('source'))
+    compiled = str(tmpdir.join('compiled'))
+    digest = str(tmpdir.join('digest'))
+    with open(source, 'wb') as f:
+        f.write(b'abc\n')
+    graph = ush.Graph(jobs=2)
+    graph.add('digest', cat(compiled) | sha256sum | digest, deps=['compile'],
+              inputs=[compiled], outputs=[digest])
+    graph.add('compile', cat(source) | fold('-w', 1) | compiled,
+              inputs=[source], outputs=[compiled])
+    graph.add('sleep', ush.Shell()(sys.executable)('-c', 'pass'))
+    result = graph.run()
+    assert result.ok
+    assert result.tasks['compile'].state == 'done'
+    assert result.tasks['digest'].returncodes == (0, 0)
+    assert result.critical_path in (['compile', 'digest'], ['sleep'])
+    with open(compiled, 'rb') as f:
+        assert f.read() == b'a\nb\nc\n'
+    result = graph.run()
+    assert result.tasks['compile'].state == 'up-to-date'
+    assert result.tasks['digest'].state == 'up-to-date'
+    assert result.tasks['sleep'].state == 'done'
+
+
+@pytest.mark.parametrize('on_failure', ['stop', 'continue'])
+def test_graph_failures(on_failure):
+    python = ush.Shell()(sys.executable)
+    graph = ush.Graph(jobs=1, on_failure=on_failure)
+    graph.add('fail', python('-c', 'raise SystemExit(2)'))
+    graph.add('dependent', python('-c', 'pass'), deps=['fail'])
+    graph.add('independent', python('-c', 'pass'))
+    result = graph.run()
+    assert not result.ok
+    assert result.tasks['fail'].state == 'failed'
+    assert result.tasks['fail'].returncodes == (2,)
+    assert result.tasks['dependent'].state == 'skipped'
+    assert result.tasks['independent'].state == (
+        'cancelled' if on_failure == 'stop' else 'done')
+
+
+def test_invalid_graph():
+    graph = ush.Graph()
+    graph.add('a', cat, deps=['b'])
+    graph.add('b', cat, deps=['a'])
+    with pytest.raises(ush.InvalidGraph):
+        graph.run()
+    with pytest.raises(ush.InvalidGraph):
+        graph.add('a', cat)
+    graph = ush.Graph()
+    graph.add('a', cat, deps=['missing'])
+    with pytest.raises(ush.InvalidGraph):
+        graph.run()
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'),
+                    reason='requires /proc')
+def test_snapshot(tmpdir):
+    import time
+    path = str(tmpdir.join('input'))
+    with open(path, 'wb') as f:
+        f.write(b'x' * (1 << 22))
+    python = ush.Shell()(sys.executable)
+    sleeper = python('-c', 'import time; time.sleep(10)')
+    handle = (cat(stdin=path) | sleeper).start()
+    try:
+        deadline = time.time() + 2
+        while time.time() < deadline:
+            first, second = handle.snapshot()
+            if first['stdout_queued'] == first['stdout_capacity']:
+                break
+            time.sleep(0.02)
+        first, second = handle.snapshot()
+        assert first['stdout_queued'] == first['stdout_capacity'] > 0
+        assert 0 < first['stdin_position'] < 1 << 22
+        assert first['state'] == 'S'
+        assert first['cpu_percent'] is not None
+        assert first['rss'] > 0
+        assert first['write_bytes'] >= first['stdout_queued']
+        assert second['pid'] == handle.pids[1]
+    finally:
+        handle.terminate()
+    assert handle.snapshot()[0]['state'] == 'exited'
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'),
+                    reason='requires /proc')
+def test_monitor_option():
+    snapshots = []
+    python = ush.Shell()(sys.executable)
+    monitor = ush.ProcMonitor(snapshots.append, interval=0.05)
+    assert python('-c', 'import time; time.sleep(0.5)', monitor=monitor)() == (
+        0,)
+    assert snapshots
+    assert snapshots[-1][0]['cpu_time'] is not None
+    assert not monitor.watching
+    snapshots = []
+    assert python('-c', 'import time; time.sleep(1.2)',
+                  monitor=snapshots.append)() == (0,)
+    assert len(snapshots) == 1
+    # no I/O to wait on, so the pipeline is only waited for after the I/O
+    # loop ended
+    snapshots = []
+    assert python('-c', 'import time; time.sleep(0.3)', stdin=ush.NULL,
+                  io_backend='threads', monitor=ush.ProcMonitor(
+                      snapshots.append, interval=0.05))() == (0,)
+    assert snapshots
+
+
+@pytest.mark.skipif(PY2, reason='requires lzma and bz2.open')
+@pytest.mark.parametrize('suffix', ['.gz', '.bz2', '.xz'])
+def test_compressed_redirects(tmpdir, suffix):
+    import bz2
+    import gzip
+    import hashlib
+    import lzma
+    opener = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}[suffix]
+    path = str(tmpdir.join('output' + suffix))
+    data = b''.join(b'%d\n' % i for i in range(100000))
+    assert (echo(data) | cat | path)() == (0,)
+    with opener(path, 'rb') as f:
+        assert f.read() == data
+    (echo(b'end\n') | cat | path + '+')()
+    with opener(path, 'rb') as f:
+        assert f.read() == data + b'end\n'
+    assert bytes(path | cat | head('-c', 6)) == b'0\n1\n2\n'
+    assert bytes(cat(stdin=path) | sha256sum) == bytes(echo(data + b'end\n') |
+                                                        sha256sum)
+    stderr = str(tmpdir.join('stderr' + suffix))
+    errmd5(stdin=path, stdout=ush.sinks.Null(), stderr=stderr)()
+    with opener(stderr, 'rb') as f:
+        assert f.read() == hashlib.md5(
+            data + b'end\n').hexdigest().encode() + b'\n'
+
+
+def test_compress_level(tmpdir):
+    data = b'abc' * 100000
+    fast = str(tmpdir.join('fast.gz'))
+    best = str(tmpdir.join('best.gz'))
+    (echo(data) | cat(compress_level=1) | fast)()
+    (echo(data) | cat(compress_level=9) | best)()
+    assert os.path.getsize(best) < os.path.getsize(fast)
+    assert ush.compile_offload_script(
+        (cat(offload=True) | fast).commands, '/dev/null') is None
+
+
+def test_compressed_input_errors(tmpdir):
+    path = str(tmpdir.join('corrupt.gz'))
+    with open(path, 'wb') as f:
+        f.write(b'not gzip data')
+    with pytest.raises(IOError):
+        (cat(stdin=path) | ush.sinks.Null())()
@@ -50,10 +50,12 @@ if sys.version_info >= (3, 5):
             'helper.py',
             'setup.py',
             'tests/__init__.py',
+            'tests/test_cache.py',
             'tests/test_chdir.py',
             'tests/test_commands.py',
             'tests/test_env.py',
             'tests/test_glob.py',
+            'tests/test_parsing.py',
             'tests/test_util.py',
             'ush.py'
         ])
@@ -65,10 +67,12 @@ if sys.version_info >= (3, 5):
             '../helper.py',
             '../setup.py',
             '../tests/__init__.py',
+            '../tests/test_cache.py',
             '../tests/test_chdir.py',
             '../tests/test_commands.py',
             '../tests/test_env.py',
             '../tests/test_glob.py',
+            '../tests/test_parsing.py',
             '../tests/test_util.py',
             '../ush.py',
             '__init__.py',
@@ -0,0 +1,146 @@
+import struct
+
+import pytest
+
+from ush import (MalformedRecord, iterate_csv, iterate_delimited,
+                 iterate_frames, iterate_json, iterate_records)
+from helper import cat, echo, errmd5, PIPE
+
+
+@pytest.fixture()
+def numpy():
+    return pytest.importorskip('numpy')
+
+
+def test_to_array(numpy):
+    arr = (echo(b'1 2.5\n3 4\n\n5 6\n') | cat).to_array()
+    assert arr.tolist() == [[1, 2.5], [3, 4], [5, 6]]
+
+
+def test_to_array_delimiter_and_columns(numpy):
+    arr = (echo(b'1,2,3\n4,5,6') | cat).to_array(int, delimiter=',',
+                                                 columns=(0, 2))
+    assert arr.dtype == int
+    assert arr.tolist() == [[1, 3], [4, 6]]
+    arr = (echo(b'1,2,3\n4,5,6\n') | cat).to_array(int, delimiter=',',
+                                                   columns=1)
+    assert arr.tolist() == [2, 5]
+
+
+def test_to_array_empty(numpy):
+    assert (echo(b'') | cat).to_array().shape == (0,)
+
+
+def test_to_array_ignores_stderr_pipes(numpy):
+    arr = (echo(b'1\n2\n') | errmd5(stderr=PIPE)).to_array(int)
+    assert arr.tolist() == [1, 2]
+
+
+@pytest.mark.parametrize('rows_per_batch', [1, 3, 7, 1000])
+def test_iter_arrays(numpy, rows_per_batch):
+    data = ''.join('{0} {1}\n'.format(i, i * 2) for i in range(100))
+    batches = list((echo(data.encode()) | cat).iter_arrays(
+        int, rows_per_batch=rows_per_batch))
+    assert all(len(b) <= rows_per_batch for b in batches)
+    assert numpy.concatenate(batches).tolist() == [
+        [i, i * 2] for i in range(100)]
+
+
+def chunk_iterator(data, chunk_size):
+    while data:
+        yield data[:chunk_size]
+        data = data[chunk_size:]
+
+
+JSON_DATA = b'{"a": 1}\n\n[1, 2]\n{"b": \n"x"\n'
+CSV_DATA = b'a,b\n1,"multi\nline"\n3,"x"y\n4,5'
+
+
+@pytest.mark.parametrize('chunk_size', list(range(1, len(JSON_DATA) + 1)))
+def test_iterate_json(chunk_size):
+    records = list(iterate_json(chunk_iterator(JSON_DATA, chunk_size)))
+    assert len(records) == 4
+    assert records[:2] == [{'a': 1}, [1, 2]]
+    assert records[3] == 'x'
+    malformed = records[2]
+    assert isinstance(malformed, MalformedRecord)
+    assert malformed.offset == 17
+    assert malformed.data == b'{"b": '
+
+
+def test_iter_json_batches_and_errors():
+    errors = []
+    data = b''.join(b'{"n": %d}\n' % i for i in range(10)) + b'oops\n'
+    batches = list((echo(data) | cat).iter_json(batch_size=4,
+                                                on_error=errors.append))
+    assert [len(b) for b in batches] == [4, 4, 2]
+    assert batches[-1] == [{'n': 8}, {'n': 9}]
+    assert [e.offset for e in errors] == [len(data) - 5]
+
+
+@pytest.mark.parametrize('chunk_size', list(range(1, len(CSV_DATA) + 1)))
+def test_iterate_csv(chunk_size):
+    errors = []
+    records = list(iterate_csv(chunk_iterator(CSV_DATA, chunk_size),
+                               strict=True, on_error=errors.append))
+    assert records == [['a', 'b'], ['1', 'multi\nline'], ['4', '5']]
+    assert len(errors) == 1
+    assert errors[0].offset == 19
+    assert errors[0].data == b'3,"x"y\n'
+
+
+def test_iter_csv_dialect():
+    records = list((echo(b'a\tb\nc\td\n') | cat).iter_csv(
+        dialect='excel-tab', batch_size=1))
+    assert records == [[['a', 'b']], [['c', 'd']]]
+
+
+RECORDS_DATA = b'abcdefghijkl'
+FRAMES_DATA = b''.join(struct.pack('>H', len(r)) + r
+                       for r in [b'a', b'', b'bcd', b'efghij'])
+DELIMITED_DATA = b'a||bc||||def'
+
+
+@pytest.mark.parametrize('chunk_size', list(range(1, len(RECORDS_DATA) + 1)))
+def test_iterate_records(chunk_size):
+    records = iterate_records(chunk_iterator(RECORDS_DATA, chunk_size), 3)
+    assert list(records) == [b'abc', b'def', b'ghi', b'jkl']
+    batches = iterate_records(chunk_iterator(RECORDS_DATA, chunk_size), 4,
+                              batch_size=2)
+    assert list(batches) == [[b'abcd', b'efgh'], [b'ijkl']]
+    with pytest.raises(MalformedRecord) as e:
+        list(iterate_records(chunk_iterator(RECORDS_DATA, chunk_size), 5))
+    assert e.value.offset == 10
+    assert e.value.data == b'kl'
+    with pytest.raises(ValueError):
+        iterate_records(chunk_iterator(RECORDS_DATA, chunk_size), 0)
+
+
+@pytest.mark.parametrize('chunk_size', list(range(1, len(FRAMES_DATA) + 1)))
+def test_iterate_frames(chunk_size):
+    frames = iterate_frames(chunk_iterator(FRAMES_DATA, chunk_size), '>H')
+    assert list(frames) == [b'a', b'', b'bcd', b'efghij']
+    with pytest.raises(MalformedRecord) as e:
+        list(iterate_frames(chunk_iterator(FRAMES_DATA[:-1], chunk_size),
+                            '>H'))
+    assert e.value.offset == 10
+    data = struct.pack('>i', 1) + b'a' + struct.pack('>i', -4) + b'bcde'
+    with pytest.raises(MalformedRecord) as e:
+        list(iterate_frames(chunk_iterator(data, chunk_size), '>i'))
+    assert e.value.offset == 5
+
+
+@pytest.mark.parametrize('chunk_size', list(range(1, len(DELIMITED_DATA) + 1)))
+def test_iterate_delimited(chunk_size):
+    records = iterate_delimited(chunk_iterator(DELIMITED_DATA, chunk_size),
+                                b'||')
+    assert list(records) == [b'a', b'bc', b'', b'def']
+
+
+def test_iter_delimited_and_frames():
+    assert list((echo(b'a\0b\0') | cat).iter_delimited()) == [b'a', b'b']
+    assert list((echo(FRAMES_DATA) | cat).iter_frames('>H',
+                                                       batch_size=3)) == [
+        [b'a', b'', b'bcd'], [b'efghij']]
+    assert list((echo(RECORDS_DATA) | cat).iter_records(6)) == [
+        b'abcdef', b'ghijkl']
@@ -1,4 +1,5 @@
 import os
+import sys
 import pytest
 
 from ush import iterate_lines
@@ -18,3 +19,46 @@ def test_iterate_lines(chunk_size):
     lines = [l for l, i in iterate_lines(chunk_iterator(DATA, chunk_size))]
     assert lines == ['Lorem ', 'ipsum dolor ', 'sit amet', '']
 
+
+# Time budget, in microseconds, for `import ush` with cached bytecode
+IMPORT_BUDGET = 10000
+LAZY_MODULES = ('subprocess', 'threading', 'glob', 're', 'select',
+                'collections', 'contextlib', 'signal', 'queue')
+# -X importtime is only available from python 3.7
+HAS_IMPORTTIME = sys.version_info >= (3, 7)
+
+
+def import_report(statement, **extra_env):
+    # returns the -X importtime lines (when supported) and the loaded modules
+    # after running `statement` in a fresh interpreter
+    import subprocess
+    env = dict(os.environ, **extra_env)
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))
+    code = 'import sys; {}; print(" ".join(sys.modules))'.format(statement)
+    args = [sys.executable, '-c', code]
+    if HAS_IMPORTTIME:
+        args[1:1] = ['-X', 'importtime']
+    output = subprocess.check_output(
+        args, env=env,
+        stderr=subprocess.STDOUT).decode('utf-8').splitlines()
+    return output[:-1], set(output[-1].split())
+
+
+def test_import_is_lazy():
+    _, baseline = import_report('pass')
+    _, modules = import_report('import ush')
+    assert not (modules - baseline) & set(LAZY_MODULES)
+
+
+@pytest.mark.skipif(not HAS_IMPORTTIME, reason='-X importtime requires 3.7')
+def test_import_time(tmpdir):
+    # the first import writes the bytecode cache, so compiling the source is
+    # not measured
+    env = {'PYTHONDONTWRITEBYTECODE': '', 'PYTHONPYCACHEPREFIX': str(tmpdir)}
+    import_report('import ush', **env)
+    lines, _ = import_report('import ush', **env)
+    ush_lines = [line for line in lines if line.endswith('| ush')]
+    assert ush_lines
+    cumulative = int(ush_lines[0].split('|')[1])
+    assert cumulative < IMPORT_BUDGET
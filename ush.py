@@ -1,34 +1,67 @@
-import collections
-import contextlib
 import errno
-import glob
 import os
-import re
-import subprocess
 import sys
-import types
+import time
 
 
 __all__ = ('Shell', 'Command', 'InvalidPipeline', 'AlreadyRedirected',
-           'ProcessError')
+           'ProcessError', 'MalformedRecord', 'py_stage', 'ResultCache',
+           'to_logger', 'spread_cpus', 'procsub', 'IOThreadPool', 'Graph',
+           'InvalidGraph', 'ProcMonitor')
 
 
-STDOUT = subprocess.STDOUT
-PIPE = subprocess.PIPE
+# Same values as subprocess.STDOUT and subprocess.PIPE. The subprocess module
+# is only imported when the first process is spawned.
+STDOUT = -2
+PIPE = -1
 # Some opts have None as a valid value, so we use EMPTY as a default value when
 # reading opts to determine if an option was passed.
 EMPTY = object()
 # Cross/platform /dev/null specifier alias
 NULL = os.devnull
 MAX_CHUNK_SIZE = 0xffff
-GLOB_PATTERNS = re.compile(r'(?:\*|\?|\[[^\]]+\])')
+# Items from list or tuple stdin sources are coalesced up to this many bytes
+# before being written to the pipe. Other iterables, which may be slow
+# producers, are written item by item unless the `stdin_buffer_size` option is
+# set.
+STDIN_BUFFER_SIZE = MAX_CHUNK_SIZE
+# iterators over items which are all available without waiting
+READY_ITERATORS = (type(iter([])), type(iter(())))
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError):
+    IOV_MAX = 16
+clock = getattr(time, 'monotonic', time.time)
+try:
+    MAXFD = os.sysconf('SC_OPEN_MAX')
+except (AttributeError, ValueError):
+    MAXFD = 256
+
+
+class LazyRegex(object):
+    """Regular expression which is only compiled when first used."""
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.regex = None
+
+    def __getattr__(self, name):
+        if self.regex is None:
+            import re
+            self.regex = re.compile(self.pattern)
+        return getattr(self.regex, name)
+
+
+GLOB_PATTERNS = LazyRegex(r'(?:\*|\?|\[[^\]]+\])')
 GLOB_OPTS = {}
+# memfd-backed output capture is only available on Linux with python 3.8+
+HAS_MEMFD = hasattr(os, 'memfd_create')
+# pidfd-based process monitoring requires Linux 5.3+ and python 3.9+
+HAS_PIDFD = hasattr(os, 'pidfd_open')
 
 # We have python2/3 compatibility, but don't want to rely on `six` package so
 # this script can be used independently.
 try:
     xrange
-    from Queue import Queue, Empty
     import StringIO
     StringIO = BytesIO = StringIO.StringIO
     def is_string(o):
@@ -37,7 +70,6 @@ try:
     PY3 = False
 except NameError:
     xrange = range
-    from queue import Queue, Empty
     import io
     StringIO = io.StringIO
     BytesIO = io.BytesIO
@@ -52,24 +84,44 @@ except NameError:
         GLOB_OPTS = {'recursive': True}
 
 
+def import_queue():
+    # the queue module imports threading, so it is only loaded by the code
+    # paths which use threads
+    module = __import__('queue' if PY3 else 'Queue')
+    return module.Queue, module.Empty, module.Full
+
+
+def cloexec_pipe():
+    # Pipes are not inherited by child processes on python 3 (PEP 446), but
+    # on python 2 every spawned process would hold copies of both ends, and
+    # the reader of the pipe would never see EOF.
+    r, w = os.pipe()
+    if not PY3 and sys.platform != 'win32':
+        import fcntl
+        for fd in (r, w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    return r, w
+
+
 if sys.platform == 'win32':
-    import threading
     def set_extra_popen_opts(opts):
         pass
     def concurrent_communicate(proc, read_streams):
         return concurrent_communicate_with_threads(proc, read_streams)
 else:
-    import select
-    from signal import signal, SIGPIPE, SIG_DFL
-    _PIPE_BUF = getattr(select, 'PIPE_BUF', 512)
     def set_extra_popen_opts(opts):
+        import signal
         user_preexec_fn = opts.get('preexec_fn', None)
+        apply_scheduling = scheduling_preexec_fn(opts)
         def preexec_fn():
             if user_preexec_fn:
                 user_preexec_fn()
             # Restore SIGPIPE default handler when forked. This is required for
             # handling pipelines correctly.
-            signal(SIGPIPE, SIG_DFL)
+            signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+            if apply_scheduling:
+                apply_scheduling()
         opts['preexec_fn'] = preexec_fn
     def concurrent_communicate(proc, read_streams):
         return concurrent_communicate_with_select(proc, read_streams)
@@ -83,14 +135,33 @@ class AlreadyRedirected(Exception):
     pass
 
 
+class InvalidGraph(Exception):
+    pass
+
+
 class ProcessError(Exception):
-    def __init__(self, process_info):
+    def __init__(self, process_info, errors=None):
+        # `errors` are the exceptions raised by failed python stages
         msg = 'One or more commands failed: {}'.format(process_info)
+        if errors:
+            msg += ', python stage errors: {!r}'.format(errors)
         super(ProcessError, self).__init__(msg)
         self.process_info = process_info
+        self.errors = errors or []
+
+
+class MalformedRecord(ValueError):
+    def __init__(self, offset, data, error):
+        msg = 'Malformed record at byte offset {0}: {1}'.format(offset, error)
+        super(MalformedRecord, self).__init__(msg)
+        self.offset = offset
+        self.data = data
+        self.error = error
 
 
 def expand_filenames(argv, cwd):
+    import glob
+
     def expand_arg(arg):
         return [os.path.relpath(p, cwd)
                 for p in glob.iglob(os.path.join(cwd, arg), **GLOB_OPTS)]
@@ -103,6 +174,89 @@ def expand_filenames(argv, cwd):
     return rv
 
 
+IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+IOPRIO_SYSCALLS = {
+    'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'riscv64': 30,
+    'armv7l': 314, 'ppc64le': 273, 'ppc64': 273, 's390x': 282,
+}
+
+
+def ioprio_setter(ionice):
+    # python has no ioprio_set wrapper, so the syscall is invoked through
+    # ctypes. Everything is resolved in the parent, the returned function is
+    # what runs in the child.
+    import ctypes
+    if is_string(ionice):
+        ionice = (ionice, 0)
+    io_class, level = ionice
+    io_class = IOPRIO_CLASSES.get(io_class, io_class)
+    machine = os.uname()[4]
+    if machine not in IOPRIO_SYSCALLS:
+        raise OSError('ionice is not supported on {}'.format(machine))
+    syscall = ctypes.CDLL(None, use_errno=True).syscall
+    args = (IOPRIO_SYSCALLS[machine], 1, 0, (io_class << 13) | level)
+
+    def set_ioprio():
+        if syscall(*args) == -1:
+            raise OSError(ctypes.get_errno(), 'ioprio_set failed')
+    return set_ioprio
+
+
+def scheduling_preexec_fn(opts):
+    cpu_affinity = opts.get('cpu_affinity', None)
+    nice = opts.get('nice', None)
+    ionice = opts.get('ionice', None)
+    oom_score_adj = opts.get('oom_score_adj', None)
+    if (cpu_affinity, nice, ionice, oom_score_adj) == (None,) * 4:
+        return None
+    set_ioprio = ioprio_setter(ionice) if ionice is not None else None
+
+    def apply_scheduling():
+        if cpu_affinity is not None:
+            os.sched_setaffinity(0, cpu_affinity)
+        if nice:
+            os.nice(nice)
+        if set_ioprio:
+            set_ioprio()
+        if oom_score_adj is not None:
+            with open('/proc/self/oom_score_adj', 'w') as f:
+                f.write(str(oom_score_adj))
+    return apply_scheduling
+
+
+class CpuSets(object):
+    """Assigns CPU sets to pipelines in round-robin order.
+
+    Can be passed as the `cpu_affinity` option (usually as a `Shell` default),
+    in which case every process of a pipeline is pinned to the same set and
+    consecutive pipelines use different sets.
+    """
+    def __init__(self, cpusets):
+        import itertools
+        self.cpusets = [frozenset(cpus) for cpus in cpusets]
+        self.counter = itertools.count()
+
+    def acquire(self):
+        return self.cpusets[next(self.counter) % len(self.cpusets)]
+
+
+def spread_cpus(count=None, cpus=None):
+    """Split `cpus` (by default, the CPUs available to this process) into
+    `count` contiguous sets, returning a `CpuSets` instance."""
+    if cpus is None:
+        cpus = os.sched_getaffinity(0)
+    cpus = sorted(cpus)
+    count = min(count or len(cpus), len(cpus))
+    size, extra = divmod(len(cpus), count)
+    cpusets = []
+    start = 0
+    for i in xrange(count):
+        end = start + size + (1 if i < extra else 0)
+        cpusets.append(cpus[start:end])
+        start = end
+    return CpuSets(cpusets)
+
+
 def update_opts_env(opts, extra_env):
     if extra_env is None:
         del opts['env']
@@ -141,7 +295,10 @@ def fileobj_has_fileno(fileobj):
 def remove_invalid_opts(opts):
     new_opts = {}
     new_opts.update(opts)
-    for opt in ('raise_on_error', 'merge_env', 'glob'):
+    for opt in ('raise_on_error', 'merge_env', 'glob', 'memfd', 'cache',
+                'cache_inputs', 'fail_fast', 'stdin_buffer_size',
+                'cpu_affinity', 'nice', 'ionice', 'oom_score_adj',
+                'io_backend', 'offload', 'monitor', 'compress_level'):
         if opt in new_opts: del new_opts[opt] 
     return new_opts
 
@@ -170,62 +327,494 @@ def iterate_lines(chunk_iterator, trim_trailing_lf=False):
             yield line, stream_id
 
 
+def iterate_line_blocks(chunk_iterator):
+    # yields (offset, block) tuples where each block only contains complete
+    # lines, except possibly the last one.
+    remaining = []
+    offset = 0
+    for chunk in chunk_iterator:
+        index = chunk.rfind(b'\n') + 1
+        if not index:
+            remaining.append(chunk)
+            continue
+        remaining.append(chunk[:index])
+        block = b''.join(remaining)
+        yield offset, block
+        offset += len(block)
+        remaining = [chunk[index:]]
+    block = b''.join(remaining)
+    if block:
+        yield offset, block
+
+
+def batch_records(records, batch_size=None, on_error=None):
+    # Malformed records are passed to `on_error` if given, otherwise they are
+    # yielded in place of the record so the consumer can inspect the offset.
+    batch = []
+    for record in records:
+        if on_error is not None and isinstance(record, MalformedRecord):
+            on_error(record)
+            continue
+        if not batch_size:
+            yield record
+            continue
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iterate_json(chunk_iterator, batch_size=None, on_error=None):
+    import json
+
+    def records():
+        for offset, block in iterate_line_blocks(chunk_iterator):
+            for line in block.split(b'\n'):
+                if line.strip():
+                    try:
+                        yield json.loads(line.decode('utf-8'))
+                    except ValueError as e:
+                        yield MalformedRecord(offset, line, e)
+                offset += len(line) + 1
+
+    return batch_records(records(), batch_size, on_error)
+
+
+def iterate_csv(chunk_iterator, dialect='excel', batch_size=None,
+                on_error=None, **fmtparams):
+    import csv
+    state = {'offset': 0, 'lines': []}
+
+    def lines():
+        for offset, block in iterate_line_blocks(chunk_iterator):
+            start = 0
+            while start < len(block):
+                end = block.find(b'\n', start) + 1 or len(block)
+                line = block[start:end]
+                state['lines'].append(line)
+                start = end
+                yield line.decode('utf-8', 'replace')
+
+    def records():
+        # a single reader is used for the whole stream so quoted fields
+        # spanning multiple chunks are handled by the csv module.
+        reader = csv.reader(lines(), dialect, **fmtparams)
+        while True:
+            try:
+                record = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as e:
+                record = MalformedRecord(state['offset'],
+                                         b''.join(state['lines']), e)
+            state['offset'] += sum(len(l) for l in state['lines'])
+            state['lines'] = []
+            yield record
+
+    return batch_records(records(), batch_size, on_error)
+
+
+def iterate_batches(record_lists, batch_size=None):
+    # flattens lists of records, or regroups them into `batch_size` lists
+    pending = []
+    for records in record_lists:
+        if not batch_size:
+            for record in records:
+                yield record
+            continue
+        if pending:
+            records = pending + records
+        end = len(records) - len(records) % batch_size
+        for i in xrange(0, end, batch_size):
+            yield records[i:i + batch_size]
+        pending = records[end:]
+    if pending:
+        yield pending
+
+
+def iterate_records(chunk_iterator, size, batch_size=None):
+    if size <= 0:
+        raise ValueError('Invalid record size {}'.format(size))
+
+    def record_lists():
+        buf = bytearray()
+        offset = 0
+        for chunk in chunk_iterator:
+            buf += chunk
+            end = len(buf) - len(buf) % size
+            records = [bytes(buf[i:i + size]) for i in xrange(0, end, size)]
+            del buf[:end]
+            offset += end
+            yield records
+        if buf:
+            raise MalformedRecord(offset, bytes(buf), 'truncated record')
+
+    return iterate_batches(record_lists(), batch_size)
+
+
+def iterate_frames(chunk_iterator, prefix='>I', batch_size=None):
+    import struct
+    header = struct.Struct(prefix)
+
+    def record_lists():
+        buf = bytearray()
+        offset = 0
+        for chunk in chunk_iterator:
+            buf += chunk
+            records = []
+            pos = 0
+            while len(buf) - pos >= header.size:
+                start = pos + header.size
+                length = header.unpack_from(buf, pos)[0]
+                if length < 0:
+                    # possible with signed prefix formats
+                    raise MalformedRecord(offset + pos, bytes(buf[pos:]),
+                                          'negative frame length')
+                end = start + length
+                if end > len(buf):
+                    break
+                records.append(bytes(buf[start:end]))
+                pos = end
+            del buf[:pos]
+            offset += pos
+            yield records
+        if buf:
+            raise MalformedRecord(offset, bytes(buf), 'truncated frame')
+
+    return iterate_batches(record_lists(), batch_size)
+
+
+def iterate_delimited(chunk_iterator, delimiter=b'\0', batch_size=None):
+    def record_lists():
+        buf = bytearray()
+        search_start = 0
+        for chunk in chunk_iterator:
+            buf += chunk
+            records = []
+            pos = 0
+            while True:
+                index = buf.find(delimiter, max(pos, search_start))
+                if index == -1:
+                    break
+                records.append(bytes(buf[pos:index]))
+                pos = index + len(delimiter)
+            del buf[:pos]
+            # don't scan again what was already searched, but consider a
+            # delimiter that may be split between chunks
+            search_start = max(len(buf) - len(delimiter) + 1, 0)
+            yield records
+        if buf:
+            yield [bytes(buf)]
+
+    return iterate_batches(record_lists(), batch_size)
+
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('numpy is required for parsing output into arrays')
+    return numpy
+
+
+def iterate_arrays(chunk_iterator, dtype=float, delimiter=None, columns=None,
+                   rows_per_batch=0x10000):
+    numpy = import_numpy()
+
+    def parse(data):
+        return numpy.loadtxt(BytesIO(data), dtype=dtype, delimiter=delimiter,
+                             usecols=columns, ndmin=2)
+
+    def squeeze(rows):
+        # like numpy.loadtxt, return 1-d arrays when there's a single column
+        return rows[:, 0] if rows.shape[1] == 1 else rows
+
+    buffered = []
+    buffered_lines = 0
+    pending = None
+    for chunk in chunk_iterator:
+        buffered.append(chunk)
+        buffered_lines += chunk.count(b'\n')
+        if buffered_lines < rows_per_batch:
+            continue
+        data = b''.join(buffered)
+        index = data.rfind(b'\n') + 1
+        buffered = [data[index:]]
+        buffered_lines = 0
+        rows = parse(data[:index])
+        if pending is not None:
+            rows = numpy.concatenate((pending, rows))
+        while len(rows) >= rows_per_batch:
+            yield squeeze(rows[:rows_per_batch])
+            rows = rows[rows_per_batch:]
+        pending = rows if len(rows) else None
+    data = b''.join(buffered)
+    if data.strip():
+        rows = parse(data)
+        if pending is not None:
+            rows = numpy.concatenate((pending, rows))
+        pending = rows
+    while pending is not None and len(pending):
+        yield squeeze(pending[:rows_per_batch])
+        pending = pending[rows_per_batch:]
+
+
+def iterate_line_batches(chunk_iterator, batch_size):
+    # yields blobs with at least `batch_size` complete lines each, except for
+    # the last one
+    blocks = []
+    lines = 0
+    for offset, block in iterate_line_blocks(chunk_iterator):
+        blocks.append(block)
+        lines += block.count(b'\n')
+        if lines >= batch_size:
+            yield b''.join(blocks)
+            blocks = []
+            lines = 0
+    if blocks:
+        yield b''.join(blocks)
+
+
+def map_line_batch(fn, blob):
+    # runs in a worker process. Lines are shipped as a single bytes object,
+    # which is much cheaper to pickle than a list of strings.
+    lines = blob.decode('utf-8').split('\n')
+    if not lines[-1]:
+        lines.pop()
+    return [fn(line) for line in lines]
+
+
+def iterate_mapped_lines(chunk_iterator, fn, workers=None, batch_size=1000,
+                         ordered=True):
+    from concurrent.futures import (ProcessPoolExecutor, FIRST_COMPLETED,
+                                    wait as wait_futures)
+    if workers is None:
+        import multiprocessing
+        workers = multiprocessing.cpu_count()
+    # bound the number of batches held in memory
+    max_in_flight = workers * 2
+    batches = iterate_line_batches(chunk_iterator, batch_size)
+    executor = ProcessPoolExecutor(workers)
+    from collections import deque
+    pending = deque()
+
+    def collect():
+        if ordered:
+            return pending.popleft().result()
+        done, not_done = wait_futures(pending, return_when=FIRST_COMPLETED)
+        future = next(iter(done))
+        pending.remove(future)
+        return future.result()
+
+    try:
+        for blob in batches:
+            pending.append(executor.submit(map_line_batch, fn, blob))
+            while len(pending) >= max_in_flight:
+                for result in collect():
+                    yield result
+        while pending:
+            for result in collect():
+                yield result
+    finally:
+        batches.close()
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
 def validate_pipeline(commands):
     for index, command in enumerate(commands):
         is_first = index == 0
         is_last = index == len(commands) - 1
         if not is_first and command.opts.get('stdin', None) is not None:
             msg = (
-                'Command {0} is not the first in the pipeline and has '
+                'Command {0!r} is not the first in the pipeline and has '
                 'stdin set to a value different than "None"'
             ).format(command)
             raise InvalidPipeline(msg)
         if not is_last and command.opts.get('stdout', None) is not None:
             msg = (
-                'Command {0} is not the last in the pipeline and has '
+                'Command {0!r} is not the last in the pipeline and has '
                 'stdout set to a value different than "None"'
             ).format(command)
             raise InvalidPipeline(msg)
 
 
-def wait(procs, raise_on_error):
+def wait(procs, raise_on_error, on_exit=None):
     status_codes = []
-    result = tuple(iterate_outputs(procs, raise_on_error, status_codes))
+    result = tuple(iterate_outputs(procs, raise_on_error, status_codes,
+                                   on_exit))
     assert result == ()
     return tuple(status_codes)
 
 
-def iterate_outputs(procs, raise_on_error, status_codes):
+def iterate_outputs(procs, raise_on_error, status_codes, on_exit=None):
     read_streams = [proc.stderr_stream for proc in procs if proc.stderr]
     if procs[-1].stdout:
         read_streams.append(procs[-1].stdout_stream)
     write_stream = procs[0].stdin_stream if procs[0].stdin else None
-    co = communicate(procs)
+    stdin_buffer_size = procs[0].opts.get('stdin_buffer_size', None)
+    if stdin_buffer_size is None:
+        # waiting for more items of a generator would delay those already
+        # pulled from it
+        stdin_buffer_size = STDIN_BUFFER_SIZE if isinstance(
+            write_stream, READY_ITERATORS) else 0
+    if any(proc.opts.get('fail_fast', False) for proc in procs):
+        on_exit = fail_fast_handler(procs, on_exit)
+    # without pidfds, exits can only be noticed by polling between I/O events
+    polling = [] if on_exit is None else [
+        proc for proc in procs
+        if proc.pidfd is None or get_io_backend(procs) is not None]
+    co = communicate(procs, on_exit)
     wchunk = None
-    while True:
-        try:
-            ri = co.send(wchunk)
-            if ri:
-                rchunk, i = ri
-                if read_streams[i]:
-                    read_streams[i].write(rchunk)
-                else:
-                    yield ri
-        except StopIteration:
-            break
-        try:
-            wchunk = next(write_stream) if write_stream else None
-        except StopIteration:
+    finished = False
+    monitor = get_monitor(procs)
+    if monitor is not None:
+        monitor.watch(procs)
+    try:
+        while True:
+            try:
+                ri = co.send(wchunk)
+                if ri:
+                    rchunk, i = ri
+                    if read_streams[i]:
+                        read_streams[i].write(rchunk)
+                    else:
+                        yield ri
+            except StopIteration:
+                break
             wchunk = None
+            if write_stream:
+                wchunk = next_stdin_chunk(write_stream, stdin_buffer_size)
+            for proc in [p for p in polling if p.poll() is not None]:
+                polling.remove(proc)
+                on_exit(proc)
+        for proc in polling:
+            proc.wait()
+            on_exit(proc)
+        for stream in read_streams:
+            # let sinks which buffer partial data know the stream has ended
+            if hasattr(stream, 'finish'):
+                stream.finish()
+        finished = True
+    finally:
+        if not finished:
+            # The consumer stopped iterating or an error happened: don't leave
+            # processes writing to pipes nobody reads.
+            co.close()
+            terminate_pipeline(procs)
+            if monitor is not None:
+                monitor.unwatch(procs)
     status_codes += [proc.wait() for proc in procs]
+    if monitor is not None:
+        # keep sampling until every process was reaped, the I/O loop may
+        # have ended long before
+        monitor.unwatch(procs)
+    failed_substitutions = wait_substitutions(procs)
+    error = join_io_threads(procs)
+    if error is not None:
+        raise error
     if raise_on_error and len(list(filter(lambda c: c != 0, status_codes))):
         process_info = [
             (proc.argv, proc.pid, proc.returncode) for proc in procs
         ]
-        raise ProcessError(process_info)
+        raise ProcessError(process_info + failed_substitutions,
+                           stage_errors(procs))
+    if failed_substitutions:
+        raise ProcessError(failed_substitutions)
+
+
+def stage_errors(procs):
+    # exceptions raised by python stages running in threads
+    return [proc.popen.error for proc in procs
+            if getattr(proc.popen, 'error', None) is not None]
+
+
+def wait_substitutions(procs):
+    # Reap the pipelines spawned for process substitutions. Returns process
+    # info of those which failed and were created with raise_on_error.
+    process_info = []
+    for proc in procs:
+        for inner_procs, inner_raise_on_error in proc.subprocs:
+            status_codes = [inner.wait() for inner in inner_procs]
+            process_info += wait_substitutions(inner_procs)
+            if inner_raise_on_error and any(status_codes):
+                process_info += [
+                    (inner.argv, inner.pid, inner.returncode)
+                    for inner in inner_procs
+                ]
+    return process_info
+
+
+def next_stdin_chunk(write_stream, buffer_size):
+    # Gather items from the stdin iterator until `buffer_size` bytes are
+    # available, so many small items are written with a single syscall.
+    # Returns a bytes object, a list of bytes objects or None when the
+    # iterator is exhausted.
+    chunks = []
+    size = 0
+    for chunk in write_stream:
+        chunk = to_cstr(chunk)
+        if not chunk:
+            continue
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= buffer_size:
+            break
+    if not chunks:
+        return None
+    return chunks[0] if len(chunks) == 1 else chunks
+
+
+def fail_fast_handler(procs, on_exit):
+    # A stage killed by SIGPIPE only means a later stage stopped reading, so
+    # it is not considered the failure that triggers the teardown.
+    import signal
+    sigpipe = -getattr(signal, 'SIGPIPE', 13)
+
+    def handler(proc):
+        if on_exit is not None:
+            on_exit(proc)
+        if proc.returncode not in (0, sigpipe):
+            # report the statuses known at the time of the failure
+            process_info = [
+                (p.argv, p.pid, p.returncode) for p in procs
+            ]
+            raise ProcessError(process_info, stage_errors(procs))
+
+    return handler
+
+
+def terminate_pipeline(procs):
+    # Closing our ends of the pipes first will make stages blocked on I/O
+    # receive SIGPIPE or EOF. Whatever is still running after that is
+    # terminated, and everything is reaped.
+    for proc in procs:
+        for stream in (proc.stdin, proc.stdout, proc.stderr):
+            if stream is not None:
+                try:
+                    stream.close()
+                except (IOError, OSError):
+                    pass
+    for proc in procs:
+        if proc.poll() is None:
+            try:
+                proc.terminate()
+            except OSError:
+                pass
+    for proc in procs:
+        proc.wait()
+    join_io_threads(procs)
+    for proc in procs:
+        for inner_procs, _ in proc.subprocs:
+            terminate_pipeline(inner_procs)
 
 
 def write_chunk(proc, chunk):
+    if isinstance(chunk, list):
+        chunk = b''.join(chunk)
     try:
         proc.stdin.write(to_cstr(chunk))
     except IOError as e:
@@ -240,13 +829,45 @@ def write_chunk(proc, chunk):
             raise
 
 
-def communicate(procs):
+def close_stdin(proc):
+    try:
+        proc.stdin.close()
+    except IOError as e:
+        # flushing buffered data to a process which exited
+        if e.errno != errno.EPIPE:
+            raise
+
+
+def get_io_backend(procs):
+    # the io_backend option of the first process which sets it. 'select' is
+    # the default where available, so it is normalized to None.
+    for proc in procs:
+        backend = proc.opts.get('io_backend', None)
+        if backend is not None:
+            if backend not in ('select', 'threads') and not hasattr(
+                    backend, 'submit'):
+                raise ValueError('Invalid io_backend "{}"'.format(backend))
+            return None if backend == 'select' else backend
+    return None
+
+
+def communicate(procs, on_exit=None):
     # make a list of (readable streams, sinks) tuples
     read_streams = [proc.stderr for proc in procs if proc.stderr]
     if procs[-1].stdout:
         read_streams.append(procs[-1].stdout)
     writer = procs[0]
+    backend = get_io_backend(procs)
+    if backend is None and any(proc.pidfd is not None for proc in procs):
+        # process exits are observed in the same select loop as the pipes
+        return concurrent_communicate_with_select(writer, read_streams, procs,
+                                                  on_exit)
     if len(read_streams + [w for w in [writer] if w.stdin]) > 1:
+        if backend == 'threads':
+            return concurrent_communicate_with_threads(writer, read_streams)
+        elif backend is not None:
+            return concurrent_communicate_with_pool(writer, read_streams,
+                                                    backend)
         return concurrent_communicate(writer, read_streams)
     if writer.stdin or len(read_streams) == 1:
         return simple_communicate(writer, read_streams)
@@ -266,7 +887,7 @@ def simple_communicate(proc, read_streams):
             if not chunk:
                 break
             write_chunk(proc, chunk)
-        proc.stdin.close()
+        close_stdin(proc)
     else:
         read_stream = read_streams[0]
         while True:
@@ -276,129 +897,317 @@ def simple_communicate(proc, read_streams):
             yield (chunk, 0)
 
 
-def concurrent_communicate_with_select(proc, read_streams):
+def set_nonblocking(fd):
+    if hasattr(os, 'set_blocking'):
+        os.set_blocking(fd, False)
+    else:
+        import fcntl
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def enqueue_chunk(write_queue, chunk):
+    if write_queue and write_queue[-1] is None:
+        # the end of input was already queued
+        return
+    if isinstance(chunk, list):
+        write_queue.extend(chunk)
+    else:
+        write_queue.append(chunk if chunk is None else to_cstr(chunk))
+
+
+def write_queued(fd, write_queue):
+    # write as much as possible from the queue to a non-blocking fd, using a
+    # single writev call for multiple queued chunks. The None marker that
+    # signals the end of input is not consumed.
+    iov = []
+    for chunk in write_queue:
+        if chunk is None or len(iov) == IOV_MAX:
+            break
+        iov.append(chunk)
+    if not iov:
+        return
+    if hasattr(os, 'writev') and len(iov) > 1:
+        written = os.writev(fd, iov)
+    else:
+        written = os.write(fd, iov[0])
+    while written:
+        chunk = write_queue[0]
+        if len(chunk) <= written:
+            write_queue.popleft()
+            written -= len(chunk)
+        else:
+            write_queue[0] = chunk[written:]
+            written = 0
+
+
+def concurrent_communicate_with_select(proc, read_streams, procs=(),
+                                       on_exit=None):
     reading = [] + read_streams
     writing = [proc.stdin] if proc.stdin else []
     indexes = dict((r.fileno(), i) for i, r in enumerate(read_streams))
-    write_queue = collections.deque()
-
-    while reading or writing:
+    import select
+    from collections import deque
+    write_queue = deque()
+    if proc.stdin:
+        # writes can't block the loop, so more than PIPE_BUF bytes may be
+        # written whenever the pipe is writable
+        set_nonblocking(proc.stdin.fileno())
+    # pidfds become readable when the process exits, which lets us notice
+    # exits in any order while still doing I/O.
+    waiting = dict((p.pidfd, p) for p in procs if p.pidfd is not None)
+
+    while reading or writing or waiting:
         try:
-            rlist, wlist, xlist = select.select(reading, writing, [])
+            rlist, wlist, xlist = select.select(reading + list(waiting),
+                                                writing, [])
         except select.error as e:
             if e.args[0] == errno.EINTR:
                 continue
             raise
 
         for rstream in rlist:
+            if rstream in waiting:
+                exited = waiting.pop(rstream)
+                exited.poll()
+                if on_exit is not None:
+                    on_exit(exited)
+                continue
             rchunk = os.read(rstream.fileno(), MAX_CHUNK_SIZE)
             if not rchunk:
                 rstream.close()
                 reading.remove(rstream)
                 continue
-            write_queue.append((yield rchunk, indexes[rstream.fileno()]))
+            enqueue_chunk(write_queue,
+                          (yield rchunk, indexes[rstream.fileno()]))
 
         if not write_queue:
-            write_queue.append((yield))
+            enqueue_chunk(write_queue, (yield))
 
         if not wlist:
             continue
 
         while write_queue:
-            wchunk = write_queue.popleft()
-            if wchunk is None:
+            if write_queue[0] is None:
+                write_queue.popleft()
                 assert not write_queue
                 writing = []
                 proc.stdin.close()
                 break
-            wchunk = to_cstr(wchunk)
-            chunk = wchunk[:_PIPE_BUF]
-            if len(wchunk) > _PIPE_BUF:
-                write_queue.appendleft(wchunk[_PIPE_BUF:])
             try:
-                written = os.write(proc.stdin.fileno(), chunk)
+                write_queued(proc.stdin.fileno(), write_queue)
             except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    # wait for the pipe buffer to be drained
+                    break
                 if e.errno != errno.EPIPE:
                     raise
                 writing = []
                 proc.stdin.close()
-            else:
-                if len(chunk) > written:
-                    write_queue.appendleft(chunk[written:])
-                    # break so we wait for the pipe buffer to be drained
-                    break
+                break
 
 
-def concurrent_communicate_with_threads(proc, read_streams):
-    def read(queue, read_stream, index):
-        while True:
-            chunk = read_stream.read(MAX_CHUNK_SIZE)
-            if not chunk:
-                break
-            queue.put((chunk, index))
-        queue.put((None, index))
+def write_fd(fd, chunk):
+    # write all of `chunk`, returning False if the reader went away
+    if isinstance(chunk, list):
+        chunk = b''.join(chunk)
+    view = memoryview(to_cstr(chunk))
+    while view:
+        try:
+            view = view[os.write(fd, view):]
+        except (IOError, OSError) as e:
+            if e.errno in (errno.EPIPE, errno.EINVAL):
+                # EINVAL is what windows reports for a process which exited
+                return False
+            raise
+    return True
+
+
+def communicate_with_workers(proc, read_streams, start, queue_size,
+                             max_workers=None):
+    # The blocking reads/writes run in worker threads started with `start`,
+    # which hand chunks over through a bounded queue. Completion is signalled
+    # through the same queue.
+    #
+    # Workers use duplicates of the pipe descriptors instead of the file
+    # objects: closing a buffered file blocks while another thread is inside
+    # read() or write(), so the pipeline could not be torn down while a
+    # worker waits for a process. When the generator is closed, workers stop
+    # at their next chunk and close their descriptors.
+    tasks = len(read_streams) + bool(proc.stdin)
+    if max_workers is not None and tasks > max_workers:
+        # the streams of a pipeline must be pumped at the same time
+        raise ValueError('pipeline needs {} I/O threads, but only {} are '
+                         'available'.format(tasks, max_workers))
+    Queue, Empty, Full = import_queue()
+    closed = []
+
+    def put(item):
+        # don't block a worker forever if the consumer went away
+        while not closed:
+            try:
+                rqueue.put(item, timeout=0.05)
+                return
+            except Full:
+                pass
 
-    def write(queue, proc):
-        while True:
-            chunk = queue.get()
-            if not chunk:
-                break
-            write_chunk(proc, chunk)
-        proc.stdin.close()
+    def read(fd, index):
+        try:
+            while not closed:
+                chunk = os.read(fd, MAX_CHUNK_SIZE)
+                if not chunk:
+                    break
+                put((chunk, index))
+        finally:
+            os.close(fd)
+            put((None, index))
 
-    rqueue = Queue(maxsize=1)
+    def write(fd):
+        try:
+            connected = True
+            while True:
+                chunk = wqueue.get()
+                if not chunk:
+                    break
+                if connected and not closed:
+                    connected = write_fd(fd, chunk)
+        finally:
+            os.close(fd)
+            close_stdin(proc)
+            put((None, None))
+
+    rqueue = Queue(maxsize=queue_size)
     wqueue = Queue()
-    threads = []
     for i, rs in enumerate(read_streams):
-        threads.append(threading.Thread(target=read, args=(rqueue, rs, i)))
-        threads[-1].setDaemon(True)
-        threads[-1].start()
-    if proc.stdin:
-        threads.append(threading.Thread(target=write, args=(wqueue, proc)))
-        threads[-1].setDaemon(True)
-        threads[-1].start()
-
-    writing = True
-    reading = len(read_streams)
-    while writing or reading or rqueue.qsize():
-        if reading or rqueue.qsize():
+        start(read, os.dup(rs.fileno()), i)
+    writing = bool(proc.stdin)
+    if writing:
+        proc.stdin.flush()
+        start(write, os.dup(proc.stdin.fileno()))
+    pending = tasks
+    try:
+        while writing or pending:
             try:
                 rchunk, index = rqueue.get(block=not writing)
-                if rchunk:
-                    wchunk = yield rchunk, index
-                else:
-                    reading -= 1
-                    continue
             except Empty:
                 wchunk = yield
-        else:
-            wchunk = yield
+            else:
+                if not rchunk:
+                    pending -= 1
+                    continue
+                wchunk = yield rchunk, index
+            if writing:
+                wqueue.put(wchunk)
+                writing = wchunk is not None
+    finally:
+        closed.append(True)
         if writing:
-            wqueue.put(wchunk)
-            writing = wchunk is not None
-    for t in threads:
-        t.join()
+            wqueue.put(None)
+
+
+def concurrent_communicate_with_threads(proc, read_streams):
+    import threading
+
+    def start(fn, *args):
+        thread = threading.Thread(target=fn, args=args)
+        thread.daemon = True
+        thread.start()
+
+    return communicate_with_workers(proc, read_streams, start, 1)
+
+
+class IOThreadPool(object):
+    """Long-lived threads which pump pipes for the threaded communicator.
+
+    Pass an instance as the `io_backend` option, usually as a Shell default,
+    to share it among pipelines. At most `size` threads are started. When all
+    of them are busy, tasks wait in a queue, so `size` must be at least the
+    number of streams (stdin, stderr pipes and stdout) of a pipeline.
+    """
+    def __init__(self, size=8, queue_size=4):
+        import threading
+        Queue, Empty, Full = import_queue()
+        self.size = size
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.tasks = Queue()
+        self.threads = 0
+        # threads waiting for a task which no submitted task was assigned to
+        self.idle = 0
+        # tasks queued because every thread was busy
+        self.backlog = 0
+
+    def submit(self, fn, *args):
+        import threading
+        with self.lock:
+            if self.idle:
+                self.idle -= 1
+            elif self.threads < self.size:
+                self.threads += 1
+                thread = threading.Thread(target=self._work, args=(fn, args))
+                thread.daemon = True
+                thread.start()
+                return
+            else:
+                self.backlog += 1
+            self.tasks.put((fn, args))
 
+    def _work(self, fn, args):
+        while True:
+            try:
+                fn(*args)
+            except Exception:
+                with self.lock:
+                    self.threads -= 1
+                raise
+            with self.lock:
+                if self.backlog:
+                    self.backlog -= 1
+                else:
+                    self.idle += 1
+            fn, args = self.tasks.get()
 
-def setup_redirect(proc_opts, key):
+
+def concurrent_communicate_with_pool(proc, read_streams, pool):
+    # Same protocol as concurrent_communicate_with_threads, with the blocking
+    # reads/writes running on `pool`. Each pipeline has its own bounded
+    # queue of chunks read ahead.
+    return communicate_with_workers(proc, read_streams, pool.submit,
+                                    pool.queue_size, pool.size)
+
+
+def setup_redirect(proc_opts, key, io_threads):
     stream = proc_opts.get(key, None)
+    if isinstance(stream, NullSink):
+        # discard at the file descriptor level, data never reaches python
+        stream = proc_opts[key] = NULL
+    if key == 'stdin' and isinstance(stream, RunningPipeline):
+        # read straight from the started pipeline's stdout pipe, which is
+        # handed over to the new process
+        proc_opts[key] = stream.detach_stdout()
+        return None, True
     if stream in (None, STDOUT, PIPE) or fileobj_has_fileno(stream):
         # Simple case which will be handled automatically by Popen: stream is
         # STDOUT/PIPE or a file object backed by file.
         return None, False
+    if is_string(stream) and is_compressed(stream):
+        # the process is connected to a pipe, and the data is compressed or
+        # decompressed by a thread on the other end
+        level = proc_opts.get('compress_level', None)
+        if key == 'stdin':
+            f = open_compressed(stream, 'rb')
+        else:
+            f = open_output_file(stream, level)
+        proc_opts[key], pump = start_codec_pump(f, key == 'stdin')
+        io_threads.append(pump)
+        return None, True
     if is_string(stream):
         # stream is a string representing a filename, we'll open the file with
         # appropriate mode which will be set to proc_opts[key].
         if key == 'stdin':
             proc_opts[key] = open(stream, 'rb')
         else:
-            if stream.endswith('+'):
-                proc_opts[key] = open(stream[:-1], 'ab')
-                # On MS Windows we need to explicitly the file position to the
-                # end or the file contents will be replaced.
-                proc_opts[key].seek(0, os.SEEK_END)
-            else:
-                proc_opts[key] = open(stream, 'wb')
+            proc_opts[key] = open_output_file(stream)
         return None, True
     if key == 'stdin':
         if hasattr(stream, 'read'):
@@ -412,6 +1221,252 @@ def setup_redirect(proc_opts, key):
     return stream, False
 
 
+def open_output_file(filename, compress_level=None):
+    if filename.endswith('+'):
+        if is_compressed(filename[:-1]):
+            # appending creates a new compressed stream after the existing
+            # one, which decompressors handle as a continuation
+            return open_compressed(filename[:-1], 'ab', compress_level)
+        f = open(filename[:-1], 'ab')
+        # On MS Windows we need to explicitly the file position to the
+        # end or the file contents will be replaced.
+        f.seek(0, os.SEEK_END)
+        return f
+    if is_compressed(filename):
+        return open_compressed(filename, 'wb', compress_level)
+    return open(filename, 'wb')
+
+
+def is_compressed(filename):
+    if filename.endswith('+'):
+        filename = filename[:-1]
+    if filename.endswith(('.gz', '.bz2')):
+        return True
+    # lzma is missing on python 2 and zstandard is a third party package,
+    # the import only probes if they are available
+    for suffix, module in (('.xz', 'lzma'), ('.zst', 'zstandard')):
+        if filename.endswith(suffix):
+            try:
+                __import__(module)
+            except ImportError:
+                # not recognized without the codec
+                return False
+            return True
+    return False
+
+
+def open_compressed(filename, mode, compress_level=None):
+    # file object which compresses or decompresses with the codec of the
+    # filename suffix
+    writing = 'r' not in mode
+    if filename.endswith('.gz'):
+        import gzip
+        return gzip.open(filename, mode, 9 if compress_level is None
+                         else compress_level)
+    elif filename.endswith('.bz2'):
+        import bz2
+        return bz2.BZ2File(filename, mode, compresslevel=9 if (
+            compress_level is None) else compress_level)
+    elif filename.endswith('.xz'):
+        import lzma
+        return lzma.open(filename, mode, preset=compress_level if writing
+                         else None)
+    import zstandard
+    cctx = None
+    if writing and compress_level is not None:
+        cctx = zstandard.ZstdCompressor(level=compress_level)
+    return zstandard.open(filename, mode, cctx=cctx)
+
+
+class CodecPump(object):
+    """Copies data between a pipe and a compressed file in a thread.
+
+    The codecs release the GIL while working on a chunk, so compression
+    doesn't block other python threads.
+    """
+    def __init__(self, f, fd, reading):
+        import threading
+        self.f = f
+        self.fd = fd
+        self.error = None
+        self.thread = threading.Thread(
+            target=self._decompress if reading else self._compress)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _decompress(self):
+        try:
+            while True:
+                chunk = self.f.read(MAX_CHUNK_SIZE * 16)
+                if not chunk:
+                    break
+                view = memoryview(chunk)
+                while view:
+                    view = view[os.write(self.fd, view):]
+        except (IOError, OSError) as e:
+            # the process exited without reading all input
+            if e.errno != errno.EPIPE:
+                self.error = e
+        except Exception as e:
+            self.error = e
+        finally:
+            os.close(self.fd)
+            self.f.close()
+
+    def _compress(self):
+        try:
+            while True:
+                chunk = os.read(self.fd, MAX_CHUNK_SIZE * 16)
+                if not chunk:
+                    break
+                self.f.write(chunk)
+        except Exception as e:
+            self.error = e
+        finally:
+            os.close(self.fd)
+            self.f.close()
+
+    def join(self):
+        self.thread.join()
+        return self.error
+
+
+def start_codec_pump(f, reading):
+    # Returns the file object to connect to the process, and the pump
+    r, w = cloexec_pipe()
+    if reading:
+        return os.fdopen(r, 'rb'), CodecPump(f, w, True)
+    return os.fdopen(w, 'wb'), CodecPump(f, r, False)
+
+
+def join_io_threads(procs):
+    # waits for the codec threads of the processes, returning the first error
+    error = None
+    for proc in procs:
+        for pump in proc.io_threads:
+            error = pump.join() or error
+        proc.io_threads = []
+    return error
+
+
+class output_target(object):
+    # context manager which returns a writable object for what would have
+    # been the stdout of a pipeline
+    def __init__(self, stream, compress_level=None):
+        self.stream = stream
+        self.compress_level = compress_level
+        self.file = None
+
+    def __enter__(self):
+        if self.stream is None:
+            sys.stdout.flush()
+            return getattr(sys.stdout, 'buffer', sys.stdout)
+        elif is_string(self.stream):
+            self.file = open_output_file(self.stream, self.compress_level)
+            return self.file
+        return self.stream
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.stream is None:
+            getattr(sys.stdout, 'buffer', sys.stdout).flush()
+        elif self.file is not None:
+            self.file.close()
+        elif hasattr(self.stream, 'finish'):
+            # let sinks which buffer partial data know the output has ended
+            self.stream.finish()
+
+
+def write_output(stream, data, compress_level=None):
+    # deliver captured output to the pipeline's stdout target
+    with output_target(stream, compress_level) as out:
+        out.write(data)
+
+
+def copy_file(src, dst):
+    # copy the contents of `src` to `dst` in the kernel, if possible
+    src.seek(0)
+    if hasattr(os, 'sendfile') and fileobj_has_fileno(dst):
+        dst.flush()
+        offset = 0
+        while True:
+            sent = os.sendfile(dst.fileno(), src.fileno(), offset,
+                               MAX_CHUNK_SIZE * 16)
+            if not sent:
+                return
+            offset += sent
+    for chunk in fileobj_to_iterator(src):
+        dst.write(chunk)
+
+
+def shard_ranges(path, shards):
+    # split a file into `shards` (start, end) byte ranges, each starting at
+    # the beginning of a line
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, 'rb') as f:
+        for i in xrange(1, shards):
+            pos = max(size * i // shards, boundaries[-1])
+            if pos:
+                f.seek(pos - 1)
+                f.readline()
+                pos = f.tell()
+            boundaries.append(min(pos, size))
+    boundaries.append(size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:])
+            if end > start] or [(0, 0)]
+
+
+def feed_range(path, start, end, wfd):
+    # write a byte range of a file into a pipe, using sendfile to avoid
+    # copying the data through python
+    try:
+        with open(path, 'rb') as f:
+            offset = start
+            if hasattr(os, 'sendfile'):
+                while offset < end:
+                    sent = os.sendfile(wfd, f.fileno(), offset,
+                                       min(end - offset, MAX_CHUNK_SIZE * 16))
+                    if not sent:
+                        break
+                    offset += sent
+            else:
+                f.seek(offset)
+                while offset < end:
+                    chunk = f.read(min(end - offset, MAX_CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    os.write(wfd, chunk)
+                    offset += len(chunk)
+    except (IOError, OSError) as e:
+        # the shard pipeline exited without consuming all input
+        if e.errno != errno.EPIPE:
+            raise
+    finally:
+        os.close(wfd)
+
+
+class LineMergeSink(object):
+    """Writes complete lines from several concurrent streams into `out`."""
+    def __init__(self, out, lock):
+        self.out = out
+        self.lock = lock
+        self.partial = b''
+
+    def write(self, chunk):
+        data = self.partial + chunk
+        index = data.rfind(b'\n') + 1
+        if index:
+            with self.lock:
+                self.out.write(data[:index])
+        self.partial = data[index:]
+
+    def finish(self):
+        if self.partial:
+            with self.lock:
+                self.out.write(self.partial)
+            self.partial = b''
+
+
 def fileobj_to_iterator(fobj):
     def iterator():
         while True:
@@ -422,6 +1477,213 @@ def fileobj_to_iterator(fobj):
     return iterator()
 
 
+class LoggerSink(object):
+    """Routes the stderr of a command into a logger.
+
+    Output is split into lines as chunks arrive from the I/O loop, and each
+    chunk's lines are emitted in records of up to `batch_lines` lines, with
+    the command and pid attached as the `command` and `pid` record attributes.
+    Lines longer than `max_line_length` are truncated and, if `rate_limit` is
+    set, lines exceeding that many per second are dropped and summarized.
+    """
+    def __init__(self, logger, level, prefix='', batch_lines=100,
+                 max_line_length=4096, rate_limit=None, pid=None,
+                 command=None):
+        self.logger = logger
+        self.level = level
+        self.prefix = prefix
+        self.batch_lines = batch_lines
+        self.max_line_length = max_line_length
+        self.rate_limit = rate_limit
+        self.pid = pid
+        self.command = command
+        self.partial = b''
+        # set after a partial line was truncated, until its line feed arrives
+        self.discarding = False
+        self.suppressed = 0
+        self.tokens = rate_limit
+        self.last_refill = clock()
+
+    def bind(self, pid, argv):
+        return LoggerSink(self.logger, self.level, self.prefix,
+                          self.batch_lines, self.max_line_length,
+                          self.rate_limit, pid, ' '.join(argv))
+
+    def write(self, chunk):
+        if self.discarding:
+            index = chunk.find(b'\n')
+            if index == -1:
+                return
+            chunk = chunk[index + 1:]
+            self.discarding = False
+        lines = (self.partial + chunk).split(b'\n')
+        self.partial = lines.pop()
+        if len(self.partial) > self.max_line_length:
+            # don't buffer unbounded data from commands which never output a
+            # line feed, the rest of the line is dropped
+            lines.append(self.partial)
+            self.partial = b''
+            self.discarding = True
+        self._emit(lines)
+
+    def finish(self):
+        if self.partial:
+            self._emit([self.partial])
+            self.partial = b''
+        self.discarding = False
+        self._emit([])
+
+    def _allowed(self, count):
+        if self.rate_limit is None:
+            return count
+        now = clock()
+        self.tokens = min(self.rate_limit, self.tokens +
+                          (now - self.last_refill) * self.rate_limit)
+        self.last_refill = now
+        allowed = min(count, int(self.tokens))
+        self.tokens -= allowed
+        return allowed
+
+    def _emit(self, lines):
+        allowed = self._allowed(len(lines))
+        batch = []
+        for line in lines[:allowed]:
+            line = line.rstrip(b'\r').decode('utf-8', 'replace')
+            if len(line) > self.max_line_length:
+                line = line[:self.max_line_length] + '...[truncated]'
+            batch.append(line)
+            if len(batch) == self.batch_lines:
+                self._log('\n'.join(batch))
+                batch = []
+        if batch:
+            self._log('\n'.join(batch))
+        self.suppressed += len(lines) - allowed
+        if self.suppressed and (allowed or not lines):
+            self._log('[{0} lines suppressed]'.format(self.suppressed))
+            self.suppressed = 0
+
+    def _log(self, message):
+        self.logger.log(self.level, '%s%s', self.prefix, message,
+                        extra={'command': self.command, 'pid': self.pid})
+
+
+class DigestSink(object):
+    """Computes a hashlib digest of the data written to it."""
+    def __init__(self, algorithm='sha256'):
+        import hashlib
+        self.hash = hashlib.new(algorithm)
+
+    def write(self, chunk):
+        self.hash.update(chunk)
+
+    def digest(self):
+        return self.hash.digest()
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+class CountSink(object):
+    """Counts bytes and, optionally, lines written to it."""
+    def __init__(self, lines=True):
+        self.count_lines = lines
+        self.bytes = 0
+        self.lines = 0
+
+    def write(self, chunk):
+        self.bytes += len(chunk)
+        if self.count_lines:
+            self.lines += chunk.count(b'\n')
+
+
+class BufferSink(object):
+    """Accumulates data in a bytearray."""
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, chunk):
+        self.data += chunk
+
+
+class NullSink(object):
+    """Discards data.
+
+    When used as a redirect target, the command's output is connected to the
+    null device, so no data is read by python at all.
+    """
+    def write(self, chunk):
+        pass
+
+
+class PartitionSink(object):
+    """Splits lines across `n` files.
+
+    `key_fn` receives each line (as bytes, without the line feed) and returns
+    an integer or a str/bytes key, which is mapped to one of the `n` files
+    named by `path_template.format(index)`.
+    """
+    def __init__(self, key_fn, n, path_template):
+        self.key_fn = key_fn
+        self.n = n
+        self.path_template = path_template
+        self.files = {}
+        self.partial = b''
+
+    def _index(self, line):
+        import zlib
+        key = self.key_fn(line)
+        if not isinstance(key, int):
+            # crc32 alone distributes poorly over small moduli, so mix its
+            # bits with fibonacci hashing
+            key = zlib.crc32(to_cstr(key)) & 0xffffffff
+            key = ((key * 0x9e3779b1) & 0xffffffff) >> 16
+        return key % self.n
+
+    def _file(self, index):
+        f = self.files.get(index, None)
+        if f is None:
+            f = self.files[index] = open(self.path_template.format(index),
+                                         'wb')
+        return f
+
+    def write(self, chunk):
+        lines = (self.partial + chunk).split(b'\n')
+        self.partial = lines.pop()
+        # group lines by partition so each file receives a single write
+        groups = {}
+        for line in lines:
+            groups.setdefault(self._index(line), []).append(line)
+        for index, group in groups.items():
+            group.append(b'')
+            self._file(index).write(b'\n'.join(group))
+
+    def finish(self):
+        if self.partial:
+            self._file(self._index(self.partial)).write(self.partial)
+            self.partial = b''
+        self.close()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+
+def to_logger(logger, level=None, prefix='', batch_lines=100,
+              max_line_length=4096, rate_limit=None):
+    """Create a `stderr` redirect target which writes to `logger`.
+
+    `logger` can be a `logging.Logger` or a logger name.
+    """
+    import logging
+    if is_string(logger):
+        logger = logging.getLogger(logger)
+    if level is None:
+        level = logging.INFO
+    return LoggerSink(logger, level, prefix, batch_lines, max_line_length,
+                      rate_limit)
+
+
 def echo(s):
     if isinstance(s, str):
         return StringIO(s)
@@ -430,14 +1692,591 @@ def echo(s):
         return BytesIO(s)
 
 
+def ignore_epipe(fn, *args):
+    try:
+        fn(*args)
+    except IOError as e:
+        # the next stage stopped reading, which is not an error
+        if e.errno != errno.EPIPE:
+            raise
+
+
+def write_py_stage_results(results, output):
+    for result in results:
+        if result is not None:
+            output.write(to_cstr(result))
+    output.flush()
+
+
+def run_py_stage(fn, mode, in_fd, out_fd):
+    import inspect
+    input = os.fdopen(in_fd, 'rb')
+    output = os.fdopen(out_fd, 'wb')
+    try:
+        if mode == 'lines':
+            items = iter(input)
+        else:
+            items = fileobj_to_iterator(input)
+        if inspect.isgeneratorfunction(fn):
+            results = fn(items)
+        else:
+            results = (fn(item) for item in items)
+        ignore_epipe(write_py_stage_results, results, output)
+    finally:
+        input.close()
+        # closing flushes whatever is still buffered, which fails again
+        # after EPIPE even though the descriptor is released
+        ignore_epipe(output.close)
+
+
+class PyStagePopen(object):
+    """Runs a python function with a `subprocess.Popen` compatible interface.
+
+    The function executes in a thread or a forked worker process, connected to
+    the other stages through real pipes, so it streams data with the same
+    backpressure as an external command.
+    """
+    def __init__(self, fn, mode, worker, stdin=None, stdout=None):
+        self.pid = None
+        self.returncode = None
+        self.error = None
+        self.stdin = None
+        self.stdout = None
+        self.stderr = None
+        in_fd = self._setup_fd(stdin, 0, True)
+        out_fd = self._setup_fd(stdout, 1, False)
+        if worker == 'process':
+            self.pid = os.fork()
+            if not self.pid:
+                self._run_forked(fn, mode, in_fd, out_fd)
+            os.close(in_fd)
+            os.close(out_fd)
+            self.worker = None
+        else:
+            import threading
+            self.worker = threading.Thread(target=self._run,
+                                           args=(fn, mode, in_fd, out_fd))
+            self.worker.daemon = True
+            self.worker.start()
+
+    def _setup_fd(self, stream, default_fd, is_input):
+        if stream == PIPE:
+            r, w = cloexec_pipe()
+            if is_input:
+                self.stdin = os.fdopen(w, 'wb')
+                return r
+            self.stdout = os.fdopen(r, 'rb')
+            return w
+        if stream is None:
+            return os.dup(default_fd)
+        if isinstance(stream, int):
+            return os.dup(stream)
+        return os.dup(stream.fileno())
+
+    def _run_forked(self, fn, mode, in_fd, out_fd):
+        status = 1
+        try:
+            # Close inherited descriptors, otherwise the worker could be
+            # holding a write end of its own input pipe and never see EOF.
+            keep = sorted((in_fd, out_fd))
+            os.closerange(3, keep[0])
+            os.closerange(keep[0] + 1, keep[1])
+            os.closerange(keep[1] + 1, MAXFD)
+            run_py_stage(fn, mode, in_fd, out_fd)
+            status = 0
+        except Exception:
+            # the exception can't reach the parent, so report it the way a
+            # python process would
+            import traceback
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+
+    def _run(self, fn, mode, in_fd, out_fd):
+        try:
+            run_py_stage(fn, mode, in_fd, out_fd)
+        except Exception as e:
+            self.error = e
+            self.returncode = 1
+        else:
+            self.returncode = 0
+
+    def terminate(self):
+        # threads can't be killed, but they stop on EOF/EPIPE once the
+        # pipeline is torn down.
+        if self.worker is None and self.returncode is None:
+            import signal
+            os.kill(self.pid, signal.SIGTERM)
+
+    def poll(self):
+        if self.returncode is not None:
+            return self.returncode
+        if self.worker is not None:
+            if self.worker.is_alive():
+                return None
+            return self.wait()
+        pid, status = os.waitpid(self.pid, os.WNOHANG)
+        if pid:
+            self.returncode = decode_wait_status(status)
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is not None:
+            return self.returncode
+        if self.worker is not None:
+            self.worker.join()
+        else:
+            self.returncode = decode_wait_status(os.waitpid(self.pid, 0)[1])
+        return self.returncode
+
+
+def decode_wait_status(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def find_executable(name, env, cwd):
+    if os.path.sep in name or (os.path.altsep and os.path.altsep in name):
+        path = os.path.join(cwd, name)
+        return path if os.path.isfile(path) else None
+    for directory in env.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(cwd, directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def value_fingerprint(value):
+    # Describes values captured by python stages. Mutable or arbitrary
+    # objects can't be compared between calls, so None is returned for them.
+    if value is None or isinstance(value, (bool, int, float)) or is_string(
+            value):
+        return [type(value).__name__, repr(value)]
+    if isinstance(value, tuple):
+        items = [value_fingerprint(v) for v in value]
+        return None if None in items else ['tuple', items]
+    if hasattr(value, '__code__'):
+        return function_fingerprint(value)
+    return None
+
+
+def function_fingerprint(fn):
+    # Identifies what a python function computes by its name, compiled code,
+    # default arguments and closure. Returns None if it can't be identified,
+    # for example for bound methods or closures over mutable objects.
+    import hashlib
+    import marshal
+    code = getattr(fn, '__code__', None)
+    if code is None or getattr(fn, '__self__', None) is not None:
+        return None
+    try:
+        values = list(fn.__defaults__ or ()) + [
+            cell.cell_contents for cell in fn.__closure__ or ()]
+    except ValueError:
+        # empty closure cell
+        return None
+    parts = [getattr(fn, '__module__', None),
+             getattr(fn, '__qualname__', fn.__name__),
+             hashlib.sha256(marshal.dumps(code)).hexdigest()]
+    for value in values:
+        parts.append(value_fingerprint(value))
+        if parts[-1] is None:
+            return None
+    return parts
+
+
+def redirect_fingerprint(stream):
+    if stream is None or isinstance(stream, int):
+        return stream
+    if is_string(stream):
+        return ['file', repr(stream)]
+    return ['object', type(stream).__name__]
+
+
+class ResultCache(object):
+    """Stores the output of deterministic pipelines.
+
+    Results are keyed on the resolved argv, environment, cwd, a digest of
+    stdin and fingerprints of the files passed with the `cache_inputs` option.
+    Only runs where every command succeeded are stored. Entries are kept in an
+    in-memory LRU and, if `path` is given, in a directory whose total size is
+    bounded by `max_bytes`.
+
+    `fingerprint` selects how input files are compared: 'stat' uses size and
+    modification time, 'content' hashes the file contents.
+    """
+    def __init__(self, path=None, max_bytes=64 * 1024 * 1024,
+                 memory_entries=128, fingerprint='stat'):
+        import threading
+        from collections import OrderedDict
+        if fingerprint not in ('stat', 'content'):
+            raise ValueError('Invalid fingerprint "{}"'.format(fingerprint))
+        self.path = path
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self.fingerprint = fingerprint
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        if path is not None and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def file_fingerprint(self, path):
+        import hashlib
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if self.fingerprint == 'stat':
+            return [st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime)]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in fileobj_to_iterator(f):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def command_fingerprint(self, command, is_last=False):
+        """Describe what `command` computes, or None if it can't be cached.
+
+        The stdout of the last command is what the cache stores, so it is the
+        only redirect left out.
+        """
+        opts = command.copy_opts()
+        cwd = os.path.realpath(opts.get('cwd', os.curdir))
+        argv = [str(a) for a in command.argv]
+        if opts.get('glob', False):
+            argv = expand_filenames(argv, cwd)
+        set_environment(opts)
+        env = opts.get('env', None)
+        if env is None:
+            env = dict(os.environ)
+        inputs = [
+            [path, self.file_fingerprint(os.path.join(cwd, path))]
+            for path in opts.get('cache_inputs', ())
+        ]
+        if isinstance(command, PyStage):
+            code = function_fingerprint(command.fn)
+            if code is None:
+                return None
+            inputs.append(['py_stage', command.mode, code])
+        else:
+            executable = find_executable(argv[0], env, cwd)
+            if executable is not None:
+                argv[0] = os.path.realpath(executable)
+                inputs.append([argv[0], self.file_fingerprint(argv[0])])
+        for arg in command.argv:
+            if isinstance(arg, ProcessSubstitution):
+                commands = [self.command_fingerprint(c)
+                            for c in arg.pipeline.commands]
+                if None in commands:
+                    return None
+                inputs.append([str(arg), commands])
+        keys = ('stderr',) if is_last else ('stdout', 'stderr')
+        redirects = [[key, redirect_fingerprint(opts.get(key, None))]
+                     for key in keys]
+        return [argv, sorted(env.items()), cwd, inputs, redirects]
+
+    def pipeline_key(self, pipeline):
+        """Compute the cache key of `pipeline`.
+
+        Returns a (pipeline, key) tuple, where key is None if the pipeline
+        can't be cached. If stdin is a python stream, it is read into memory
+        to compute the digest and the returned pipeline is fed from the
+        buffered data.
+        """
+        import hashlib
+        import json
+        commands = pipeline.commands
+        first = commands[0]
+        stream = first.get_opt('stdin', None)
+        if stream is None:
+            stdin = None
+        elif is_string(stream):
+            stdin = ['file', stream, self.file_fingerprint(stream)]
+        else:
+            if hasattr(stream, 'read'):
+                data = b''.join(fileobj_to_iterator(stream))
+            else:
+                data = b''.join(to_cstr(chunk) for chunk in stream)
+            stdin = ['data', hashlib.sha256(data).hexdigest()]
+            commands = [first(stdin=BytesIO(data))] + commands[1:]
+        parts = [stdin] + [
+            self.command_fingerprint(c, i == len(commands) - 1)
+            for i, c in enumerate(commands)
+        ]
+        if None in parts[1:]:
+            # a python stage whose result can't be identified
+            return Pipeline(commands), None
+        key = hashlib.sha256(
+            json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+        return Pipeline(commands), key
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key + '.result')
+
+    def get(self, key):
+        with self.lock:
+            entry = self.memory.pop(key, None)
+            if entry is None and self.path is not None:
+                try:
+                    entry = self._read_entry(key)
+                    # update mtime so disk eviction is also least recently
+                    # used
+                    os.utime(self._entry_path(key), None)
+                except (IOError, OSError, ValueError, TypeError):
+                    entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            self._remember(key, entry)
+            return entry
+
+    def put(self, key, status_codes, data):
+        import json
+        entry = (tuple(status_codes), data)
+        with self.lock:
+            self.stats['stores'] += 1
+            self._remember(key, entry)
+            if self.path is None:
+                return
+            tmp_path = '{0}.{1}.tmp'.format(self._entry_path(key), os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(json.dumps(entry[0]).encode('ascii') + b'\n')
+                f.write(data)
+            if sys.platform == 'win32' and os.path.exists(
+                    self._entry_path(key)):
+                os.remove(self._entry_path(key))
+            os.rename(tmp_path, self._entry_path(key))
+            self._evict_disk()
+
+    def _read_entry(self, key):
+        # Entries are a JSON line with the status codes followed by the raw
+        # output. Nothing that could execute code is loaded, since the
+        # directory may be shared.
+        import json
+        with open(self._entry_path(key), 'rb') as f:
+            status_codes = json.loads(f.readline().decode('ascii'))
+            if not isinstance(status_codes, list):
+                raise ValueError('Invalid cache entry')
+            return tuple(int(c) for c in status_codes), f.read()
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            if self.path is not None:
+                for name in os.listdir(self.path):
+                    if name.endswith('.result'):
+                        os.remove(os.path.join(self.path, name))
+
+    def _remember(self, key, entry):
+        self.memory[key] = entry
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _evict_disk(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if not name.endswith('.result'):
+                continue
+            path = os.path.join(self.path, name)
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            self.stats['evictions'] += 1
+
+
+def read_proc_file(pid, name):
+    with open('/proc/{}/{}'.format(pid, name), 'rb') as f:
+        return f.read()
+
+
+def read_pipe_fill(pid, fd):
+    # Returns (queued bytes, capacity) of the pipe connected to `fd` of a
+    # process. A new descriptor for the pipe is opened through /proc, so this
+    # works after the parent closed its own copy.
+    import fcntl
+    import stat
+    import struct
+    import termios
+    path = '/proc/{}/fd/{}'.format(pid, fd)
+    try:
+        if not stat.S_ISFIFO(os.stat(path).st_mode):
+            return None, None
+        pipe = os.open(path, os.O_RDONLY | os.O_NONBLOCK | os.O_NOCTTY)
+    except OSError:
+        return None, None
+    try:
+        queued = struct.unpack('i', fcntl.ioctl(pipe, termios.FIONREAD,
+                                                b'\0' * 4))[0]
+        # F_GETPIPE_SZ, which the fcntl module only exports on python 3.10+
+        capacity = fcntl.fcntl(pipe, getattr(fcntl, 'F_GETPIPE_SZ', 1032))
+        return queued, capacity
+    except (IOError, OSError):
+        return None, None
+    finally:
+        os.close(pipe)
+
+
+def read_stdin_position(pid):
+    # offset of a process in a regular file connected to stdin, which tells
+    # how far a stage progressed through its input
+    import stat
+    try:
+        if not stat.S_ISREG(os.stat('/proc/{}/fd/0'.format(pid)).st_mode):
+            return None
+        for line in read_proc_file(pid, 'fdinfo/0').splitlines():
+            if line.startswith(b'pos:'):
+                return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def get_monitor(procs):
+    for proc in procs:
+        monitor = proc.opts.get('monitor', None)
+        if monitor is not None:
+            if not isinstance(monitor, ProcMonitor):
+                monitor = proc.opts['monitor'] = ProcMonitor(monitor)
+            return monitor
+    return None
+
+
+class ProcMonitor(object):
+    """Samples the resource usage of pipeline processes from /proc.
+
+    `snapshot(procs)` returns a dict for each process with its state, cpu
+    time, cpu usage since the previous snapshot (`cpu_percent`), resident
+    memory, bytes read and written, the fill level of the pipe connected to
+    its stdout and its position in a file connected to stdin. A stage whose
+    stdout pipe is full is waiting for the next stage.
+
+    When used as the `monitor` option, `callback` is called with snapshots
+    every `interval` seconds while the pipeline runs. The interval grows if
+    sampling would take more than `max_overhead` of the time. A callable
+    passed as the option is wrapped in a ProcMonitor.
+    """
+    def __init__(self, callback=None, interval=1.0, max_overhead=0.01):
+        self.callback = callback
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.previous = {}
+        self.watching = {}
+
+    def snapshot(self, procs):
+        clock_ticks = os.sysconf('SC_CLK_TCK')
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        now = clock()
+        rv = []
+        for proc in procs:
+            stats = {
+                'pid': proc.pid, 'argv': proc.argv, 'state': None,
+                'cpu_time': None, 'cpu_percent': None, 'rss': None,
+                'read_bytes': None, 'write_bytes': None,
+                'stdout_queued': None, 'stdout_capacity': None,
+                'stdin_position': None,
+            }
+            rv.append(stats)
+            if proc.returncode is not None:
+                # reaped, the pid could belong to another process by now
+                stats['state'] = 'exited'
+                self.previous.pop(proc.pid, None)
+                continue
+            try:
+                data = read_proc_file(proc.pid, 'stat')
+            except (IOError, OSError):
+                continue
+            # the command name can contain spaces and parentheses
+            fields = data[data.rindex(b')') + 2:].split()
+            stats['state'] = fields[0].decode('ascii')
+            cpu_time = float(int(fields[11]) + int(fields[12])) / clock_ticks
+            stats['cpu_time'] = cpu_time
+            stats['rss'] = int(fields[21]) * page_size
+            if proc.pid in self.previous:
+                last_cpu_time, last_time = self.previous[proc.pid]
+                if now > last_time:
+                    stats['cpu_percent'] = (100 * (cpu_time - last_cpu_time) /
+                                            (now - last_time))
+            self.previous[proc.pid] = (cpu_time, now)
+            try:
+                for line in read_proc_file(proc.pid, 'io').splitlines():
+                    key, value = line.split(b':')
+                    if key == b'rchar':
+                        stats['read_bytes'] = int(value)
+                    elif key == b'wchar':
+                        stats['write_bytes'] = int(value)
+            except (IOError, OSError):
+                pass
+            stats['stdout_queued'], stats['stdout_capacity'] = \
+                read_pipe_fill(proc.pid, 1)
+            stats['stdin_position'] = read_stdin_position(proc.pid)
+        return rv
+
+    def watch(self, procs):
+        # sample `procs` in a background thread until `unwatch` is called
+        import threading
+        stop = threading.Event()
+
+        def sample():
+            interval = self.interval
+            while not stop.wait(interval):
+                start = clock()
+                snapshot = self.snapshot(procs)
+                # keep the time spent sampling within the overhead bound
+                interval = max(self.interval,
+                               (clock() - start) / self.max_overhead)
+                if self.callback is not None:
+                    self.callback(snapshot)
+
+        thread = threading.Thread(target=sample)
+        thread.daemon = True
+        self.watching[id(procs)] = (stop, thread)
+        thread.start()
+
+    def unwatch(self, procs):
+        stop, thread = self.watching.pop(id(procs))
+        stop.set()
+        thread.join()
+        for proc in procs:
+            self.previous.pop(proc.pid, None)
+
+
+def open_pidfd(pid):
+    if pid is None or not HAS_PIDFD:
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except OSError:
+        # not supported by the kernel
+        return None
+
+
 class RunningProcess(object):
     def __init__(self, popen, stdin_stream, stdout_stream, stderr_stream,
-                 argv):
+                 argv, opts=None):
         self.popen = popen
         self.stdin_stream = stdin_stream
         self.stdout_stream = stdout_stream
         self.stderr_stream = stderr_stream
         self.argv = argv
+        self.opts = opts or {}
+        self.pidfd = open_pidfd(popen.pid)
+        self.start_time = clock()
+        self.end_time = None
+        # (procs, raise_on_error) of pipelines started for process
+        # substitutions in argv
+        self.subprocs = []
+        # CodecPump instances for compressed redirects
+        self.io_threads = []
 
     @property
     def returncode(self):
@@ -460,10 +2299,311 @@ class RunningProcess(object):
         return self.popen.pid
 
     def wait(self):
-        return self.popen.wait()
+        rv = self.popen.wait()
+        self._close_pidfd()
+        return rv
 
     def poll(self):
-        return self.popen.poll()
+        rv = self.popen.poll()
+        if rv is not None:
+            self._close_pidfd()
+        return rv
+
+    def _close_pidfd(self):
+        if self.pidfd is not None:
+            os.close(self.pidfd)
+            self.pidfd = None
+
+    def terminate(self):
+        return self.popen.terminate()
+
+
+class OutputIterator(object):
+    """Iterator over the output of a pipeline.
+
+    Closing the iterator, explicitly or by leaving a `with` block, tears down
+    the pipeline: pipes are closed, processes still running are terminated
+    and every process is reaped.
+    """
+    def __init__(self, pipeline, raw):
+        # filled once the pipeline is spawned. A list is used so the
+        # generator doesn't reference this object, which would create a cycle
+        # and delay teardown of abandoned iterators until garbage collection.
+        self.procs = []
+        self.generator = pipeline._iter(raw, self.procs)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.generator)
+
+    next = __next__
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.generator.close()
+
+
+# options which can be expressed by a shell script, or which don't affect how
+# processes are spawned
+OFFLOAD_OPTS = frozenset(('stdin', 'stdout', 'stderr', 'env', 'cwd',
+                          'raise_on_error', 'merge_env', 'glob', 'offload',
+                          'io_backend', 'stdin_buffer_size'))
+SHELL_NAME_RE = LazyRegex(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def shell_quote(arg):
+    try:
+        from shlex import quote
+    except ImportError:
+        from pipes import quote
+    return quote(arg)
+
+
+def offload_redirect(stream, key):
+    # shell redirection equivalent to a stdio option, or None if the option
+    # needs python
+    if isinstance(stream, NullSink):
+        stream = NULL
+    if stream is None:
+        return ''
+    if key == 'stderr' and stream == STDOUT:
+        return ' 2>&1'
+    if not is_string(stream) or is_compressed(stream):
+        return None
+    operator = {'stdin': '<', 'stdout': '>', 'stderr': '2>'}[key]
+    if key != 'stdin' and stream.endswith('+'):
+        operator = operator.replace('>', '>>')
+        stream = stream[:-1]
+    # files are opened relative to the python process, not the command cwd
+    return ' {} {}'.format(operator, shell_quote(os.path.abspath(stream)))
+
+
+def compile_offload_script(commands, status_path):
+    """Compile a pipeline into a /bin/sh script.
+
+    Each stage writes "<index> <status>" to `status_path` when it exits.
+    Returns None if the pipeline has options which need python to run.
+    """
+    stages = []
+    for index, command in enumerate(commands):
+        if isinstance(command, PyStage):
+            return None
+        opts = command.copy_opts()
+        if any(opt not in OFFLOAD_OPTS for opt in opts):
+            return None
+        argv = []
+        for arg in command.argv:
+            if isinstance(arg, ProcessSubstitution):
+                return None
+            argv.append(str(arg))
+        cwd = opts.get('cwd', None)
+        if opts.get('glob', False):
+            argv = expand_filenames(argv, os.path.realpath(cwd or os.curdir))
+        redirects = ''
+        for key in ('stdin', 'stdout', 'stderr'):
+            if key == 'stdin' and index > 0 or key == 'stdout' and (
+                    index < len(commands) - 1):
+                continue
+            redirect = offload_redirect(opts.get(key, None), key)
+            if redirect is None:
+                return None
+            redirects += redirect
+        script = ' '.join(shell_quote(arg) for arg in argv)
+        env = opts.get('env', None)
+        if env is not None:
+            merge_env = opts.get('merge_env', True)
+            names = [k for k in sorted(env) if env[k] is not None]
+            unset = [k for k in sorted(env) if env[k] is None]
+            if merge_env and not unset and all(
+                    SHELL_NAME_RE.match(k) for k in names):
+                # plain assignments don't need to exec env(1)
+                prefix = ' '.join('{}={}'.format(k, shell_quote(env[k]))
+                                  for k in names)
+            else:
+                prefix = 'env' if merge_env else 'env -i'
+                prefix = ' '.join([prefix] +
+                                  ['-u ' + shell_quote(k) for k in unset] +
+                                  [shell_quote('{}={}'.format(k, env[k]))
+                                   for k in names])
+            script = '{} {}'.format(prefix, script) if prefix else script
+        script += redirects
+        if cwd is not None:
+            script = 'cd {} && {}'.format(shell_quote(cwd), script)
+        stages.append('({}; echo "{} $?" >> {})'.format(
+            script, index, shell_quote(status_path)))
+    return ' | '.join(stages)
+
+
+def run_offloaded(commands):
+    # Run a pipeline as a single /bin/sh process. Returns the status codes,
+    # or None if the pipeline can't be offloaded.
+    if sys.platform == 'win32' or not PY3:
+        # the status pipe is passed with Popen's pass_fds
+        return None
+    r, w = os.pipe()
+    popen = None
+    try:
+        script = compile_offload_script(commands, '/dev/fd/{}'.format(w))
+        if script is not None:
+            import subprocess
+            popen = subprocess.Popen(['/bin/sh', '-c', script],
+                                     pass_fds=(w,))
+    finally:
+        os.close(w)
+        if popen is None:
+            os.close(r)
+    if popen is None:
+        return None
+    try:
+        returncode = popen.wait()
+        # every stage reported before the shell exited, so the data is in
+        # the pipe buffer. Stages could have leaked the descriptor to
+        # background processes, so don't wait for EOF.
+        set_nonblocking(r)
+        data = b''
+        while True:
+            try:
+                chunk = os.read(r, MAX_CHUNK_SIZE)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                break
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        os.close(r)
+    import signal
+    status_codes = [returncode] * len(commands)
+    for line in data.decode('ascii').splitlines():
+        index, status = (int(field) for field in line.split())
+        # The shell reports processes killed by signal N as 128 + N. Only
+        # statuses which map to a valid signal number are converted, so an
+        # exit status in that range (129 up to 128 + NSIG) is ambiguous.
+        if 128 < status < 128 + signal.NSIG:
+            status = 128 - status
+        status_codes[index] = status
+    if any(c.get_opt('raise_on_error', False) for c in commands) and any(
+            status_codes):
+        process_info = [
+            ([str(a) for a in c.argv], None, status)
+            for c, status in zip(commands, status_codes)
+        ]
+        raise ProcessError(process_info)
+    return tuple(status_codes)
+
+
+class Result(object):
+    """Outcome of `Pipeline.run()`.
+
+    `stdout` is the output of the last command and `stderr` a list with the
+    error output of each command, or a single value when merged. Both are
+    None when not captured. `durations` has the wall-clock time of each
+    process, and `duration` the time of the whole pipeline, in seconds.
+    """
+    __slots__ = ('stdout', 'stderr', 'returncodes', 'pids', 'durations',
+                 'duration')
+
+    def __init__(self, stdout, stderr, returncodes, pids, durations,
+                 duration):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncodes = returncodes
+        self.pids = pids
+        self.durations = durations
+        self.duration = duration
+
+    def __repr__(self):
+        return 'Result(returncodes={!r}, duration={:.6f})'.format(
+            self.returncodes, self.duration)
+
+
+class RunningPipeline(object):
+    """Handle to a pipeline started with `Pipeline.start()`."""
+    def __init__(self, procs, raise_on_error):
+        self.procs = procs
+        self.raise_on_error = raise_on_error
+        self.status_codes = None
+        self.monitor = None
+
+    @property
+    def pids(self):
+        return [proc.pid for proc in self.procs]
+
+    @property
+    def stdout(self):
+        return self.procs[-1].stdout
+
+    def snapshot(self):
+        """Return the current resource usage of each process.
+
+        See ProcMonitor.snapshot for the reported values.
+        """
+        if self.monitor is None:
+            self.monitor = ProcMonitor()
+        return self.monitor.snapshot(self.procs)
+
+    def detach_stdout(self):
+        stdout = self.stdout
+        if stdout is None:
+            raise InvalidPipeline('pipeline stdout is not available')
+        self.procs[-1].popen.stdout = None
+        return stdout
+
+    def __or__(self, other):
+        if isinstance(other, Command):
+            other = Pipeline([other])
+        assert isinstance(other, Pipeline)
+        return Pipeline([other.commands[0]._redirect('stdin', self)] +
+                        other.commands[1:])
+
+    def wait(self):
+        """Wait for the pipeline and return its status codes.
+
+        Output which wasn't consumed from `stdout` is discarded.
+        """
+        if self.status_codes is None:
+            status_codes = []
+            for chunk in iterate_outputs(self.procs, self.raise_on_error,
+                                         status_codes):
+                pass
+            self.status_codes = tuple(status_codes)
+        return self.status_codes
+
+    def terminate(self):
+        terminate_pipeline(self.procs)
+        if self.status_codes is None:
+            self.status_codes = tuple(proc.returncode for proc in self.procs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.terminate()
+        else:
+            self.wait()
+
+
+class StackContext(object):
+    # pushes `item` to `stack` for the duration of a `with` block
+    def __init__(self, stack, item):
+        self.stack = stack
+        self.item = item
+
+    def __enter__(self):
+        self.stack.append(self.item)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        item = self.stack.pop()
+        assert item == self.item
 
 
 class Shell(object):
@@ -490,14 +2630,9 @@ class Shell(object):
             rv.append(Command(argv, shell=self, **opts))
         return rv[0] if len(rv) == 1 else rv
 
-    @contextlib.contextmanager
     def setenv(self, env):
-        self.envstack.append(env)
-        yield
-        e = self.envstack.pop()
-        assert e == env
+        return StackContext(self.envstack, env)
 
-    @contextlib.contextmanager
     def chdir(self, path):
         path = str(path)  # allow pathlib.Path instances
         if path[0] != '/':
@@ -506,10 +2641,7 @@ class Shell(object):
             if self.dirstack:
                 path = os.path.normpath('{}/{}'.format(self.dirstack[-1],
                                                        path))
-        self.dirstack.append(path)
-        yield
-        p = self.dirstack.pop()
-        assert p == path
+        return StackContext(self.dirstack, path)
 
     def alias(self, **aliases):
         self.aliases.update(aliases)
@@ -526,24 +2658,35 @@ class Shell(object):
         globals()[module_name] = module
 
 
-class ShellModule(types.ModuleType):
+ModuleType = type(sys)
+
+
+class ShellModule(ModuleType):
     def __init__(self, shell, name):
+        # `shell` can also be a function which creates the shell when the
+        # module is first used
         self.__shell = shell
         self.__file__ = '<frozen>'
         self.__name__ = name
         self.__package__ = __package__
         self.__loader__ = None
 
+    def __get_shell(self):
+        if not isinstance(self.__shell, Shell):
+            self.__shell = self.__shell()
+        return self.__shell
+
     def __repr__(self):
-        return repr(self.__shell)
+        return repr(self.__get_shell())
 
     def __getattr__(self, name):
         if name.startswith('__'):
             return super(ShellModule, self).__getattr__(name) 
-        attr = getattr(self.__shell, name, None)
+        shell = self.__get_shell()
+        attr = getattr(shell, name, None)
         if attr and name != 'export_as_module':
             return attr
-        return self.__shell(name)
+        return shell(name)
 
 
 class PipelineBasePy3(object):
@@ -576,6 +2719,10 @@ class Pipeline(PipelineBasePy3 if PY3 else PipelineBasePy2):
         elif hasattr(other, 'write') or is_string(other):
             return Pipeline(self.commands[:-1] +
                             [self.commands[-1]._redirect('stdout', other)])
+        elif isinstance(other, Pipeline):
+            # both sides are joined into a single pipeline, so the data flows
+            # between them through an OS pipe
+            return Pipeline(self.commands + other.commands)
         assert isinstance(other, Command)
         return Pipeline(self.commands + [other])
 
@@ -586,16 +2733,156 @@ class Pipeline(PipelineBasePy3 if PY3 else PipelineBasePy2):
         assert False, "Invalid"
 
     def __call__(self):
+        cache = self._get_cache()
+        if cache is not None:
+            status_codes, data = self._run_cached(cache)
+            last = self.commands[-1]
+            write_output(last.get_opt('stdout', None), data,
+                         last.get_opt('compress_level', None))
+            return status_codes
+        if any(c.get_opt('offload', False) for c in self.commands):
+            status_codes = run_offloaded(self.commands)
+            if status_codes is not None:
+                return status_codes
         procs, raise_on_error = self._spawn()
         return wait(procs, raise_on_error)
 
     def __iter__(self):
-        return self._iter(False)
+        return OutputIterator(self, False)
+
+    def run(self, capture=True, stderr='stage', encoding=None):
+        """Run the pipeline and return a Result.
+
+        With `capture`, stdout of the last command and stderr of every
+        command are collected, unless redirected elsewhere. `stderr` can be
+        'stage' to keep the error output of each command apart, or 'merged'.
+        If `encoding` is given, captured data is decoded to strings.
+        """
+        if stderr not in ('stage', 'merged'):
+            raise ValueError('Invalid stderr mode "{}"'.format(stderr))
+        commands = list(self.commands)
+        stdout_sink = None
+        stderr_sinks = [None] * len(commands)
+        if capture:
+            if commands[-1].get_opt('stdout', None) is None:
+                stdout_sink = BufferSink()
+                commands[-1] = commands[-1](stdout=stdout_sink)
+            merged = BufferSink() if stderr == 'merged' else None
+            for index, command in enumerate(commands):
+                if command.get_opt('stderr', None) is None:
+                    stderr_sinks[index] = merged or BufferSink()
+                    commands[index] = command(stderr=stderr_sinks[index])
+        start_time = clock()
+        procs, raise_on_error = Pipeline(commands)._spawn()
+
+        def on_exit(proc):
+            if proc.end_time is None:
+                proc.end_time = clock()
+
+        try:
+            returncodes = wait(procs, raise_on_error, on_exit)
+        finally:
+            end_time = clock()
+        durations = tuple(
+            (proc.end_time or end_time) - proc.start_time for proc in procs)
+
+        def output(sink):
+            if sink is None:
+                return None
+            return bytes(sink.data) if encoding is None else \
+                sink.data.decode(encoding)
+
+        if capture and stderr == 'merged':
+            stderr_output = output(merged)
+        elif capture:
+            stderr_output = [output(sink) for sink in stderr_sinks]
+        else:
+            stderr_output = None
+        return Result(output(stdout_sink), stderr_output, returncodes,
+                      tuple(proc.pid for proc in procs), durations,
+                      end_time - start_time)
+
+    def start(self):
+        """Spawn the pipeline without waiting for it.
+
+        Returns a RunningPipeline handle. If the last command doesn't redirect
+        stdout, the output is available from the handle's `stdout`, and the
+        handle can be piped into other pipelines at the file descriptor level.
+        """
+        commands = self.commands
+        if commands[-1].get_opt('stdout', None) is None:
+            commands = commands[:-1] + [commands[-1](stdout=PIPE)]
+        procs, raise_on_error = Pipeline(commands)._spawn()
+        if has_python_streams(procs):
+            terminate_pipeline(procs)
+            raise InvalidPipeline(
+                'started pipelines can only redirect to files')
+        return RunningPipeline(procs, raise_on_error)
+
+    def _get_cache(self):
+        if isinstance(self.commands[0].get_opt('stdin', None),
+                      RunningPipeline):
+            # the input can't be replayed
+            return None
+        for command in self.commands:
+            cache = command.get_opt('cache', None)
+            if cache is not None:
+                return cache
+        return None
 
-    def _iter(self, raw):
+    def _run_cached(self, cache):
+        pipeline, key = cache.pipeline_key(self)
+        entry = cache.get(key) if key is not None else None
+        if entry is not None:
+            return entry
+        sink = BytesIO()
+        pipeline = Pipeline(pipeline.commands[:-1] +
+                            [pipeline.commands[-1](stdout=sink)])
+        procs, raise_on_error = pipeline._spawn()
+        status_codes = wait(procs, raise_on_error)
+        if key is not None and not any(status_codes):
+            cache.put(key, status_codes, sink.getvalue())
+        return status_codes, sink.getvalue()
+
+    def _iter_cached(self, cache, raw):
+        pipeline, key = cache.pipeline_key(self)
+        entry = cache.get(key) if key is not None else None
+        status_codes = []
+        chunks = []
+        if entry is not None:
+            iterator = iter([(entry[1], 0)] if entry[1] else [])
+        else:
+            pipeline = Pipeline(
+                pipeline.commands[:-1] +
+                [pipeline.commands[-1]._redirect('stdout', PIPE)])
+            procs, raise_on_error = pipeline._spawn()
+
+            def iterator():
+                for chunk, stream_index in iterate_outputs(
+                        procs, raise_on_error, status_codes):
+                    chunks.append(chunk)
+                    yield chunk, stream_index
+            iterator = iterator()
+        if not raw:
+            iterator = iterate_lines(iterator, trim_trailing_lf=True)
+        for item, stream_index in iterator:
+            yield item
+        if key is not None and entry is None and status_codes and not any(
+                status_codes):
+            cache.put(key, status_codes, b''.join(chunks))
+
+    def _iter(self, raw, spawned=None):
+        cache = self._get_cache()
+        if cache is not None and not any(
+                c.get_opt('stderr', None) == PIPE for c in self.commands):
+            for item in self._iter_cached(cache, raw):
+                yield item
+            return
         pipeline = Pipeline(self.commands[:-1] +
                             [self.commands[-1]._redirect('stdout', PIPE)])
         procs, raise_on_error = pipeline._spawn()
+        if spawned is not None:
+            spawned.extend(procs)
         pipe_count = sum(1 for proc in procs if proc.stderr)
         if procs[-1].stdout:
             pipe_count += 1
@@ -603,25 +2890,136 @@ class Pipeline(PipelineBasePy3 if PY3 else PipelineBasePy2):
             wait(procs, raise_on_error)
             # nothing to yield
             return
-        iterator = iterate_outputs(procs, raise_on_error, [])
+        outputs = iterate_outputs(procs, raise_on_error, [])
+        iterator = outputs
         if not raw:
             iterator = iterate_lines(iterator, trim_trailing_lf=True)
-        if pipe_count == 1:
-            for line, stream_index in iterator:
-                yield line
-        else:
-            for line, stream_index in iterator:
-                yield tuple(line if stream_index == index else None
-                            for index in xrange(pipe_count))
+        try:
+            if pipe_count == 1:
+                for line, stream_index in iterator:
+                    yield line
+            else:
+                for line, stream_index in iterator:
+                    yield tuple(line if stream_index == index else None
+                                for index in xrange(pipe_count))
+        finally:
+            outputs.close()
 
     def _collect_output(self):
+        cache = self._get_cache()
+        if cache is not None:
+            return self._run_cached(cache)[1]
+        if HAS_MEMFD and self.commands[-1].get_opt('memfd', False):
+            return self._collect_output_memfd()
         sink = BytesIO()
         (self | sink)()
         return sink.getvalue()
 
+    def _collect_output_memfd(self):
+        # The last command writes directly into an anonymous memory file,
+        # which is mapped after the pipeline exits. This skips the read loop
+        # and the intermediate BytesIO buffer.
+        import mmap
+        fd = os.memfd_create('ush-stdout', os.MFD_CLOEXEC)
+        with os.fdopen(fd, 'w+b') as sink:
+            (self | sink)()
+            size = os.fstat(fd).st_size
+            if not size:
+                return b''
+            mapping = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+            try:
+                return mapping[:]
+            finally:
+                mapping.close()
+
+    def parallel(self, input, shards=None, split='lines', ordered=True):
+        """Run copies of the pipeline concurrently over shards of a file.
+
+        `input` is split into `shards` line-aligned byte ranges, each fed to
+        its own copy of the pipeline straight from the file. With `ordered`,
+        outputs are concatenated in shard order, otherwise lines are written
+        as they arrive. Returns a list with the status codes of each shard.
+        """
+        import tempfile
+        import threading
+        if split != 'lines':
+            raise ValueError('Unsupported split mode "{}"'.format(split))
+        if shards is None:
+            import multiprocessing
+            shards = multiprocessing.cpu_count()
+        ranges = shard_ranges(input, shards)
+        first = self.commands[0]
+        last = self.commands[-1]
+        target = last.get_opt('stdout', None)
+        results = [None] * len(ranges)
+        errors = []
+        # exceptions other than ProcessError, raised in the shard threads
+        failures = []
+        spools = []
+        threads = []
+        lock = threading.Lock()
+
+        def feed_shard(start, end, w):
+            try:
+                feed_range(input, start, end, w)
+            except Exception as e:
+                failures.append(e)
+
+        def run_shard(index, start, end, stdout):
+            r, w = cloexec_pipe()
+            stdin = os.fdopen(r, 'rb')
+            try:
+                commands = ([first._redirect('stdin', stdin)] +
+                            self.commands[1:])
+                commands[-1] = commands[-1](stdout=None)._redirect('stdout',
+                                                                   stdout)
+                procs, raise_on_error = Pipeline(commands)._spawn()
+            except Exception as e:
+                os.close(w)
+                failures.append(e)
+                return
+            finally:
+                stdin.close()
+            feeder = threading.Thread(target=feed_shard, args=(start, end, w))
+            feeder.daemon = True
+            feeder.start()
+            try:
+                results[index] = wait(procs, raise_on_error)
+            except ProcessError as e:
+                results[index] = tuple(proc.returncode for proc in procs)
+                errors.append(e)
+            except Exception as e:
+                failures.append(e)
+            feeder.join()
+
+        with output_target(target, last.get_opt('compress_level',
+                                                None)) as out:
+            for index, (start, end) in enumerate(ranges):
+                if ordered:
+                    spools.append(tempfile.TemporaryFile())
+                    stdout = spools[-1]
+                else:
+                    stdout = LineMergeSink(out, lock)
+                threads.append(threading.Thread(
+                    target=run_shard, args=(index, start, end, stdout)))
+                threads[-1].start()
+            for index, thread in enumerate(threads):
+                thread.join()
+                if ordered:
+                    with spools[index] as spool:
+                        copy_file(spool, out)
+        if failures:
+            raise failures[0]
+        if errors:
+            raise ProcessError([info for e in errors
+                                for info in e.process_info],
+                               [error for e in errors for error in e.errors])
+        return results
+
     def _spawn(self):
         procs = []
         raise_on_error = False
+        cpusets = {}
         for index, command in enumerate(self.commands):
             close_in = False
             close_out = False
@@ -632,36 +3030,78 @@ class Pipeline(PipelineBasePy3 if PY3 else PipelineBasePy2):
             stdout_stream = None
             stderr_stream = None
             # copy argv/opts
-            proc_argv = [str(a) for a in command.argv]
             proc_opts = command.copy_opts()
+            subprocs = []
+            subfds = []
+            io_threads = []
+            proc_argv = []
+            for arg in command.argv:
+                if isinstance(arg, ProcessSubstitution):
+                    try:
+                        arg = arg.spawn(proc_opts, subprocs, subfds)
+                    except Exception:
+                        close_substitutions(subprocs, subfds)
+                        raise
+                proc_argv.append(str(arg))
             raise_on_error = raise_on_error or proc_opts.get('raise_on_error',
                                                              False)
             if is_first:
                 # first command in the pipeline may redirect stdin
-                stdin_stream, close_in = setup_redirect(proc_opts, 'stdin')
+                stdin_stream, close_in = setup_redirect(proc_opts, 'stdin',
+                                                        io_threads)
             else:
                 # only set current process stdin if it is not the first in the
                 # pipeline.
                 proc_opts['stdin'] = procs[-1].stdout
             if is_last:
                 # last command in the pipeline may redirect stdout
-                stdout_stream, close_out = setup_redirect(proc_opts, 'stdout')
+                stdout_stream, close_out = setup_redirect(proc_opts, 'stdout',
+                                                          io_threads)
             else:
                 # only set current process stdout if it is not the last in the
                 # pipeline.
                 proc_opts['stdout'] = PIPE
             # stderr may be set at any point in the pipeline
-            stderr_stream, close_err = setup_redirect(proc_opts, 'stderr')
+            stderr_stream, close_err = setup_redirect(proc_opts, 'stderr',
+                                                      io_threads)
+            cpu_affinity = proc_opts.get('cpu_affinity', None)
+            if hasattr(cpu_affinity, 'acquire'):
+                # policy objects assign one cpu set to the whole pipeline
+                if cpu_affinity not in cpusets:
+                    cpusets[cpu_affinity] = cpu_affinity.acquire()
+                proc_opts['cpu_affinity'] = cpusets[cpu_affinity]
             set_extra_popen_opts(proc_opts)
             if proc_opts.get('glob', False):
                 proc_argv = expand_filenames(
                     proc_argv, os.path.realpath(
                         proc_opts.get('cwd', os.curdir)))
             set_environment(proc_opts)
+            try:
+                if isinstance(command, PyStage):
+                    popen = command.popen(proc_opts)
+                else:
+                    import subprocess
+                    popen = subprocess.Popen(proc_argv,
+                                             **remove_invalid_opts(proc_opts))
+            except Exception:
+                close_substitutions(subprocs, subfds)
+                # let codec threads see EOF/EPIPE
+                for key, close in (('stdin', close_in), ('stdout', close_out),
+                                   ('stderr', close_err)):
+                    if close:
+                        proc_opts[key].close()
+                raise
+            # the substituted descriptors now belong to the process
+            for fd in subfds:
+                os.close(fd)
+            if hasattr(stderr_stream, 'bind'):
+                # sinks which need to know about the process they serve
+                stderr_stream = stderr_stream.bind(popen.pid, proc_argv)
             current_proc = RunningProcess(
-                subprocess.Popen(proc_argv, **remove_invalid_opts(proc_opts)),
-                stdin_stream, stdout_stream, stderr_stream, proc_argv
-                )
+                popen, stdin_stream, stdout_stream, stderr_stream, proc_argv,
+                proc_opts)
+            current_proc.subprocs = subprocs
+            current_proc.io_threads = io_threads
             # if files were opened and connected to the process stdio, close
             # our copies of the descriptors
             if close_in:
@@ -678,12 +3118,114 @@ class Pipeline(PipelineBasePy3 if PY3 else PipelineBasePy2):
         return procs, raise_on_error
 
     def iter_raw(self):
-        return self._iter(True)
+        return OutputIterator(self, True)
+
+    def _iter_stdout(self):
+        # Raw stdout chunks, skipping any stderr pipes.
+        with OutputIterator(self, True) as chunks:
+            for chunk in chunks:
+                if isinstance(chunk, tuple):
+                    chunk = chunk[-1]
+                    if chunk is None:
+                        continue
+                yield chunk
+
+    def head(self, lines=None, bytes=None):
+        """Return the first `lines` lines or the first `bytes` bytes of output.
+
+        Reading stops as soon as enough output was received, and the pipeline
+        is torn down without waiting for the producer to finish.
+        """
+        if (lines is None) == (bytes is None):
+            raise TypeError('head() requires one of "lines" or "bytes"')
+        if not lines and not bytes:
+            return [] if lines is not None else b''
+        stdout = self._iter_stdout()
+        try:
+            if bytes is not None:
+                chunks = []
+                size = 0
+                for chunk in stdout:
+                    chunks.append(chunk)
+                    size += len(chunk)
+                    if size >= bytes:
+                        break
+                return b''.join(chunks)[:bytes]
+            rv = []
+            for line, stream_index in iterate_lines(
+                    ((chunk, 0) for chunk in stdout), trim_trailing_lf=True):
+                rv.append(line)
+                if len(rv) == lines:
+                    break
+            return rv
+        finally:
+            stdout.close()
+
+    def first(self, pattern):
+        """Return the first output line matching `pattern`, or None."""
+        if is_string(pattern):
+            import re
+            pattern = re.compile(pattern)
+        stdout = self._iter_stdout()
+        try:
+            for line, stream_index in iterate_lines(
+                    ((chunk, 0) for chunk in stdout), trim_trailing_lf=True):
+                if pattern.search(line):
+                    return line
+            return None
+        finally:
+            stdout.close()
+
+    def iter_arrays(self, dtype=float, delimiter=None, columns=None,
+                    rows_per_batch=0x10000):
+        return iterate_arrays(self._iter_stdout(), dtype, delimiter, columns,
+                              rows_per_batch)
+
+    def iter_json(self, batch_size=None, on_error=None):
+        return iterate_json(self._iter_stdout(), batch_size, on_error)
+
+    def iter_csv(self, dialect='excel', batch_size=None, on_error=None,
+                 **fmtparams):
+        return iterate_csv(self._iter_stdout(), dialect, batch_size, on_error,
+                           **fmtparams)
+
+    def iter_records(self, size, batch_size=None):
+        return iterate_records(self._iter_stdout(), size, batch_size)
+
+    def iter_frames(self, prefix='>I', batch_size=None):
+        return iterate_frames(self._iter_stdout(), prefix, batch_size)
+
+    def iter_delimited(self, delimiter=b'\0', batch_size=None):
+        return iterate_delimited(self._iter_stdout(), delimiter, batch_size)
+
+    def map_lines(self, fn, workers=None, batch_size=1000, ordered=True):
+        """Yield `fn(line)` for each output line, using a process pool.
+
+        Lines are sent to `workers` processes in batches of `batch_size`, and
+        results are yielded in output order unless `ordered` is False, in
+        which case batches are yielded as they complete. `fn` must be
+        picklable.
+        """
+        if not PY3:
+            raise NotImplementedError(
+                'map_lines requires python 3 (concurrent.futures)')
+        return iterate_mapped_lines(self._iter_stdout(), fn, workers,
+                                    batch_size, ordered)
+
+    def to_array(self, dtype=float, delimiter=None, columns=None):
+        numpy = import_numpy()
+        batches = list(self.iter_arrays(dtype, delimiter, columns))
+        if not batches:
+            return numpy.empty((0,), dtype=dtype)
+        return numpy.concatenate(batches)
 
 
 class Command(object):
     OPTS = ('stdin', 'stdout', 'stderr', 'env', 'cwd', 'preexec_fn',
-            'raise_on_error', 'merge_env', 'glob')
+            'raise_on_error', 'merge_env', 'glob', 'memfd', 'cache',
+            'cache_inputs', 'fail_fast', 'stdin_buffer_size', 'cpu_affinity',
+            'nice', 'ionice', 'oom_score_adj', 'io_backend', 'offload',
+            'monitor', 'compress_level')
 
     def __init__(self, argv, shell=None, **opts):
         self.argv = tuple(argv)
@@ -711,7 +3253,7 @@ class Command(object):
         return Command(self.argv + argv, shell=self.shell, **new_opts)
 
     def __repr__(self):
-        argstr = ' '.join(self.argv)
+        argstr = ' '.join(str(a) for a in self.argv)
         optstr = ' '.join(
             '{}={}'.format(key, self.get_opt(key))
             for key in self.iter_opts() if self.get_opt(key, None) is not None
@@ -747,6 +3289,42 @@ class Command(object):
     def iter_raw(self):
         return Pipeline([self]).iter_raw()
 
+    def start(self):
+        return Pipeline([self]).start()
+
+    def run(self, *args, **kwargs):
+        return Pipeline([self]).run(*args, **kwargs)
+
+    def head(self, lines=None, bytes=None):
+        return Pipeline([self]).head(lines, bytes)
+
+    def first(self, pattern):
+        return Pipeline([self]).first(pattern)
+
+    def iter_arrays(self, *args, **kwargs):
+        return Pipeline([self]).iter_arrays(*args, **kwargs)
+
+    def iter_json(self, *args, **kwargs):
+        return Pipeline([self]).iter_json(*args, **kwargs)
+
+    def iter_csv(self, *args, **kwargs):
+        return Pipeline([self]).iter_csv(*args, **kwargs)
+
+    def iter_records(self, *args, **kwargs):
+        return Pipeline([self]).iter_records(*args, **kwargs)
+
+    def iter_frames(self, *args, **kwargs):
+        return Pipeline([self]).iter_frames(*args, **kwargs)
+
+    def iter_delimited(self, *args, **kwargs):
+        return Pipeline([self]).iter_delimited(*args, **kwargs)
+
+    def map_lines(self, *args, **kwargs):
+        return Pipeline([self]).map_lines(*args, **kwargs)
+
+    def to_array(self, *args, **kwargs):
+        return Pipeline([self]).to_array(*args, **kwargs)
+
     def get_env(self):
         if not self.shell.envstack and 'env' not in self.opts:
             return None
@@ -788,23 +3366,349 @@ class Command(object):
                 rv[opt] = val
         return rv
 
-builtin_sh = Shell(raise_on_error=True)
-builtin_sh.alias(
-    apt_cache='apt-cache',
-    apt_get='apt-get',
-    apt_key='apt-key',
-    dpkg_divert='dpkg-divert',
-    grub_install='grub-install',
-    grub_mkconfig='grub-mkconfig',
-    locale_gen='locale-gen',
-    mkfs_ext2='mkfs.ext2',
-    mkfs_ext3='mkfs.ext3',
-    mkfs_ext4='mkfs.ext4',
-    mkfs_vfat='mkfs.vfat',
-    qemu_img='qemu-img',
-    repo_add='repo-add',
-    update_grub='update-grub',
-    update_initramfs='update-initramfs',
-    update_locale='update-locale',
-    )
-builtin_sh.export_as_module('sh')
+class PyStage(Command):
+    def __init__(self, fn, mode='lines', worker='thread', shell=None,
+                 **opts):
+        if mode not in ('lines', 'chunks'):
+            raise ValueError('Invalid mode "{}"'.format(mode))
+        if worker not in ('thread', 'process'):
+            raise ValueError('Invalid worker "{}"'.format(worker))
+        self.fn = fn
+        self.mode = mode
+        self.worker = worker
+        name = getattr(fn, '__name__', repr(fn))
+        super(PyStage, self).__init__(('py_stage', name),
+                                      shell=shell or Shell(), **opts)
+
+    def __call__(self, *argv, **opts):
+        if argv:
+            raise TypeError('python stages do not accept arguments')
+        if not opts:
+            return Pipeline([self])()
+        new_opts = self.opts.copy()
+        new_opts.update(opts)
+        return PyStage(self.fn, self.mode, self.worker, shell=self.shell,
+                       **new_opts)
+
+    def popen(self, proc_opts):
+        return PyStagePopen(self.fn, self.mode, self.worker,
+                            proc_opts.get('stdin', None),
+                            proc_opts.get('stdout', None))
+
+
+class TaskResult(object):
+    """Outcome of a Graph task.
+
+    `state` is one of 'done', 'up-to-date', 'failed', 'skipped' (a
+    dependency failed) or 'cancelled' (not started after a failure).
+    """
+    __slots__ = ('state', 'returncodes', 'error', 'start_time', 'end_time')
+
+    def __init__(self, state, returncodes=None, error=None, start_time=None,
+                 end_time=None):
+        self.state = state
+        self.returncodes = returncodes
+        self.error = error
+        self.start_time = start_time
+        self.end_time = end_time
+
+    @property
+    def duration(self):
+        if self.start_time is None:
+            return 0
+        return self.end_time - self.start_time
+
+    def __repr__(self):
+        return 'TaskResult(state={!r}, returncodes={!r})'.format(
+            self.state, self.returncodes)
+
+
+class GraphResult(object):
+    def __init__(self, tasks, critical_path, duration):
+        self.tasks = tasks
+        self.critical_path = critical_path
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return all(t.state in ('done', 'up-to-date')
+                   for t in self.tasks.values())
+
+
+class Graph(object):
+    """Runs commands, pipelines or other callables in dependency order.
+
+    Up to `jobs` tasks run concurrently. Tasks declaring `outputs` are skipped
+    when all outputs are newer than every input, like make. After a failure,
+    no more tasks are started if `on_failure` is 'stop', while 'continue'
+    only skips the tasks which depend on the failed one.
+    """
+    def __init__(self, jobs=None, on_failure='stop'):
+        if on_failure not in ('stop', 'continue'):
+            raise ValueError('Invalid failure policy "{}"'.format(on_failure))
+        if jobs is None:
+            import multiprocessing
+            jobs = multiprocessing.cpu_count()
+        self.jobs = max(jobs, 1)
+        self.on_failure = on_failure
+        self.tasks = {}
+        # insertion order, which is not kept by dicts before python 3.7
+        self.names = []
+
+    def add(self, name, task, deps=(), inputs=(), outputs=()):
+        if name in self.tasks:
+            raise InvalidGraph('Task "{}" already exists'.format(name))
+        self.tasks[name] = (task, tuple(deps), tuple(inputs), tuple(outputs))
+        self.names.append(name)
+
+    def _order(self):
+        # topological order of the tasks, validating the graph
+        order = []
+        state = {}
+
+        def visit(name, path):
+            if state.get(name) == 'visited':
+                return
+            if state.get(name) == 'visiting':
+                raise InvalidGraph('Dependency cycle: {}'.format(
+                    ' -> '.join(path + [name])))
+            state[name] = 'visiting'
+            for dep in self.tasks[name][1]:
+                if dep not in self.tasks:
+                    raise InvalidGraph('Task "{}" depends on unknown task '
+                                       '"{}"'.format(name, dep))
+                visit(dep, path + [name])
+            state[name] = 'visited'
+            order.append(name)
+
+        for name in self.names:
+            visit(name, [])
+        return order
+
+    def _up_to_date(self, name):
+        task, deps, inputs, outputs = self.tasks[name]
+        if not outputs:
+            return False
+        try:
+            oldest_output = min(os.stat(path).st_mtime for path in outputs)
+        except OSError:
+            return False
+        return all(os.stat(path).st_mtime <= oldest_output
+                   for path in inputs if os.path.exists(path))
+
+    def _execute(self, name, results, completed):
+        task = self.tasks[name][0]
+        result = results[name]
+        result.start_time = clock()
+        try:
+            rv = task()
+            result.returncodes = rv if isinstance(rv, tuple) else None
+            failed = bool(result.returncodes) and any(result.returncodes)
+            result.state = 'failed' if failed else 'done'
+        except Exception as e:
+            result.error = e
+            result.state = 'failed'
+        result.end_time = clock()
+        completed.put(name)
+
+    def run(self):
+        import threading
+        from collections import OrderedDict
+        Queue, Empty, Full = import_queue()
+        order = self._order()
+        start_time = clock()
+        results = OrderedDict((name, TaskResult('pending')) for name in order)
+        completed = Queue()
+        pending = list(order)
+        running = 0
+        stopped = False
+        while pending or running:
+            for name in list(pending):
+                if running >= self.jobs or stopped:
+                    break
+                deps = self.tasks[name][1]
+                states = [results[dep].state for dep in deps]
+                if any(state in ('failed', 'skipped') for state in states):
+                    results[name].state = 'skipped'
+                    pending.remove(name)
+                    continue
+                if any(state not in ('done', 'up-to-date')
+                       for state in states):
+                    continue
+                pending.remove(name)
+                if self._up_to_date(name):
+                    results[name].state = 'up-to-date'
+                    continue
+                results[name].state = 'running'
+                thread = threading.Thread(target=self._execute,
+                                          args=(name, results, completed))
+                thread.daemon = True
+                thread.start()
+                running += 1
+            if not running:
+                # tasks are visited in topological order, so everything which
+                # could start without waiting was handled by the loop above
+                break
+            completed.get()
+            running -= 1
+            if (self.on_failure == 'stop' and
+                    any(r.state == 'failed' for r in results.values())):
+                stopped = True
+        for name in pending:
+            states = [results[dep].state for dep in self.tasks[name][1]]
+            failed = any(state in ('failed', 'skipped') for state in states)
+            results[name].state = 'skipped' if failed else 'cancelled'
+        return GraphResult(results, self._critical_path(order, results),
+                           clock() - start_time)
+
+    def _critical_path(self, order, results):
+        # chain of dependencies with the longest total duration
+        cost = {}
+        previous = {}
+        for name in order:
+            deps = self.tasks[name][1]
+            best = max(deps, key=lambda d: cost[d]) if deps else None
+            cost[name] = results[name].duration + (cost[best] if best else 0)
+            previous[name] = best
+        if not cost:
+            return []
+        name = max(order, key=lambda n: cost[n])
+        path = []
+        while name is not None:
+            path.append(name)
+            name = previous[name]
+        return path[::-1]
+
+
+def py_stage(fn, mode='lines', worker='thread'):
+    """Wrap a python function so it can be used as a pipeline stage.
+
+    If `fn` is a generator function, it receives an iterator of input items
+    (lines or chunks, depending on `mode`) and yields output data. Otherwise
+    it is called once per input item and its return value, if not None, is
+    written to the next stage.
+    """
+    return PyStage(fn, mode, worker)
+
+
+class ProcessSubstitution(object):
+    def __init__(self, pipeline, mode):
+        self.pipeline = pipeline
+        self.mode = mode
+
+    def __repr__(self):
+        return '{}({!r})'.format('<' if self.mode == 'r' else '>',
+                                 self.pipeline)
+
+    __str__ = __repr__
+
+    def spawn(self, proc_opts, subprocs, subfds):
+        # Start the substituted pipeline connected to one end of a new pipe.
+        # The other end is inherited by the process being spawned, which
+        # receives it as a /dev/fd path.
+        r, w = cloexec_pipe()
+        if self.mode == 'r':
+            inner_fd, outer_fd, key, mode = w, r, 'stdout', 'wb'
+        else:
+            inner_fd, outer_fd, key, mode = r, w, 'stdin', 'rb'
+        commands = list(self.pipeline.commands)
+        index = -1 if key == 'stdout' else 0
+        try:
+            with os.fdopen(inner_fd, mode) as stream:
+                commands[index] = commands[index]._redirect(key, stream)
+                procs, raise_on_error = Pipeline(commands)._spawn()
+        except Exception:
+            os.close(outer_fd)
+            raise
+        subprocs.append((procs, raise_on_error))
+        subfds.append(outer_fd)
+        if has_python_streams(procs):
+            raise InvalidPipeline(
+                'process substitutions can only redirect to files')
+        proc_opts['pass_fds'] = (tuple(proc_opts.get('pass_fds', ())) +
+                                 (outer_fd,))
+        return '/dev/fd/{}'.format(outer_fd)
+
+
+def has_python_streams(procs):
+    # True if data of any process must be pumped by python
+    return any(proc.stdin_stream is not None or
+               proc.stdout_stream is not None or
+               proc.stderr_stream is not None for proc in procs)
+
+
+def close_substitutions(subprocs, subfds):
+    # cleanup after failing to spawn a process which uses substitutions
+    for fd in subfds:
+        os.close(fd)
+    for procs, _ in subprocs:
+        terminate_pipeline(procs)
+
+
+def procsub(cmd, mode='r'):
+    """Wrap a command or pipeline so it can be used as an argument.
+
+    The argument is replaced by a /dev/fd path connected to the output
+    (mode 'r', like `<(cmd)`) or to the input (mode 'w', like `>(cmd)`) of
+    `cmd`, which runs alongside the command that receives it.
+    """
+    if mode not in ('r', 'w'):
+        raise ValueError('Invalid process substitution mode "{}"'.format(mode))
+    if not PY3:
+        # the /dev/fd descriptor is passed with Popen's pass_fds
+        raise NotImplementedError('process substitution requires python 3')
+    if isinstance(cmd, Command):
+        cmd = Pipeline([cmd])
+    return ProcessSubstitution(cmd, mode)
+
+
+sinks = ModuleType(__name__ + '.sinks')
+sinks.__doc__ = 'Streaming sinks which can be used as redirect targets.'
+sinks.Digest = DigestSink
+sinks.Count = CountSink
+sinks.Null = NullSink
+sinks.Partition = PartitionSink
+sinks.__all__ = ('Digest', 'Count', 'Null', 'Partition')
+sys.modules[sinks.__name__] = sinks
+
+
+def load_builtin_sh():
+    global builtin_sh
+    if 'builtin_sh' in globals():
+        return builtin_sh
+    builtin_sh = Shell(raise_on_error=True)
+    builtin_sh.alias(
+        apt_cache='apt-cache',
+        apt_get='apt-get',
+        apt_key='apt-key',
+        dpkg_divert='dpkg-divert',
+        grub_install='grub-install',
+        grub_mkconfig='grub-mkconfig',
+        locale_gen='locale-gen',
+        mkfs_ext2='mkfs.ext2',
+        mkfs_ext3='mkfs.ext3',
+        mkfs_ext4='mkfs.ext4',
+        mkfs_vfat='mkfs.vfat',
+        qemu_img='qemu-img',
+        repo_add='repo-add',
+        update_grub='update-grub',
+        update_initramfs='update-initramfs',
+        update_locale='update-locale',
+        )
+    return builtin_sh
+
+
+def __getattr__(name):
+    # the builtin shell is created on first use
+    if name == 'builtin_sh':
+        return load_builtin_sh()
+    raise AttributeError('module {!r} has no attribute {!r}'.format(
+        __name__, name))
+
+
+if sys.version_info < (3, 7):
+    # module __getattr__ is not supported
+    load_builtin_sh()
+sh = ShellModule(load_builtin_sh, __name__ + '.sh')
+sys.modules[sh.__name__] = sh
+